@@ -16,6 +16,21 @@ param = {
 }
 
 filename = 'CTD'
+aact_refresh = None
+aact_snapshot = None
+watermark_filename = 'aact_watermark'
+aact_delta_dir = 'aact_delta'
+aact_workers = 4
+aact_stream = ['CTD_1', 'CTD_2']
+aact_batch_rows = 100000
+cache_dir = 'cache'
+enum_columns = {
+    'CTD_1': ['study_type', 'overall_status', 'phase', 'sampling_method', 
+              'gender'],
+    'CTD_2': ['cat_title'],
+    'CTD_3': ['intervention_type'],
+    'CTD_4': ['agency_class', 'lead_or_collaborator']
+    }
 
 urls = {
     'Map_1': 'https://raw.githubusercontent.com/pantapps/cbms2019/refs/heads/'\
@@ -24,19 +39,29 @@ urls = {
     'Map_2': 'https://raw.githubusercontent.com/pantapps/cbms2019/refs/heads/'\
     'master/mesh_snomedct_via_icd10cm_not_mapped_umls.tsv'
     }
+
+map_checksums = {
+    'Map_1': None,
+    'Map_2': None
+    }
     
 f_list = {
     'list_1':[f"{filename}_1.csv", f"{filename}_2.csv", f"{filename}_3.csv", 
         f"{filename}_4.csv", f"{filename}_5.csv", f"{filename}_6.csv"],
     
     'list_2': ['DD.csv', 'u_flags.csv','b_output.csv','MICD.csv',\
-        'dht_icd10.csv']
+        'dht_icd10.csv', 'icd10_blocks.csv']
     }
 
 openAI_Model = "gpt-4o-mini"
 chunks = 5
 ctdwn = 1
 batch_filename = 'b_output'
+b_concurrent = True
+label_cache_filename = 'label_cache.sqlite'
+b_manifest_filename = 'b_manifest'
+pack_size = 20
+pack_retries = 2
 
 prompt_template = '''
 You are provided with a labeling task: label the phrase {exp} with one and only 
@@ -51,6 +76,19 @@ where
 and 'piv_cat' designates the assigned label from list {cat}.
 '''
 
+packed_prompt_template = '''
+You are provided with a labeling task: label each phrase in the list {exps} 
+with one and only one of the labels in the list {cat}. All phrases describe 
+the category {title}. Output the result as a JSON object:
+
+{{"labels": [{{"id": ..., "piv_cat": ...}}, ...]}},
+
+with exactly one entry per phrase, where
+
+'id' = the id of the phrase in the list {exps}
+and 'piv_cat' designates the assigned label from list {cat}.
+'''
+
 cat_dict = {
     'gender': ['male', 'female', 'other', 'unknown_g'],
     'age' : ['<18 years', 'between 18 and 65 years', '>65 years', 'unknown_a'],
@@ -59,11 +97,57 @@ cat_dict = {
               'Native Hawaian or Other Pacific Islander', 'White', 'unknown_r']
 }
 
+pre_classify = True
+
+age_bins = {
+    '<18 years': (0, 18),
+    'between 18 and 65 years': (18, 66),
+    '>65 years': (65, float('inf'))
+}
+
+cat_synonyms = {
+    'gender': {
+        'male': ['males', 'man', 'men', 'boy', 'boys', 'm', 'sex: male',
+                 'gender: male', 'male sex', 'male gender'],
+        'female': ['females', 'woman', 'women', 'girl', 'girls', 'f',
+                   'sex: female', 'gender: female', 'female sex',
+                   'female gender'],
+        'other': ['non-binary', 'nonbinary', 'transgender', 'intersex',
+                  'other gender'],
+        'unknown_g': ['unknown', 'not reported', 'unknown or not reported',
+                      'missing', 'not collected', 'not available']
+    },
+    'age': {
+        'unknown_a': ['unknown', 'not reported', 'unknown or not reported',
+                      'missing', 'not collected', 'not available']
+    },
+    'race': {
+        'American Indian or Alaska Native': ['american indian',
+            'alaska native', 'american indian/alaska native',
+            'american indian or alaskan native'],
+        'Asian': ['asians', 'asian american', 'east asian', 'south asian'],
+        'Black or African American': ['black', 'african american',
+            'black/african american', 'black or african-american',
+            'african-american'],
+        'Hispanic or Latino': ['hispanic', 'latino', 'latina', 'latinx',
+            'hispanic/latino', 'hispanic or latina', 'hispanic or latinx'],
+        'Native Hawaian or Other Pacific Islander': [
+            'native hawaiian or other pacific islander', 'native hawaiian',
+            'pacific islander', 'native hawaiian/other pacific islander'],
+        'White': ['caucasian', 'white/caucasian', 'white or caucasian'],
+        'unknown_r': ['unknown', 'not reported', 'unknown or not reported',
+                      'missing', 'not collected', 'not available']
+    }
+}
+
 dflg_filename = '_DHT_Flags'
 dflg_colname = 'DHT'
 dflg_columns = columns = ['official_title', 'name', 'q_3_desc', 'q_7_desc', 
                           'title', 'q_8_desc', 'measure', 'q_9_desc', 
                           'q_10_desc']
+dflg_engine = 'automaton'
+dflg_sample = None
+dflg_workers = None
 
 group = 'nct_id'
 
@@ -94,3 +178,5 @@ ICD10_descriptor = [
                      'Services'),
     ('U00', 'U99', 'Special purposes')
 ]
+
+icd10_rollup_filename = 'ICD10_rollup'
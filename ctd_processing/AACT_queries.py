@@ -8,7 +8,14 @@ Created on Fri Nov 22 17:35:26 2024
 import psycopg2
 import pandas as pd
 import os
-from config.settings import param, path, filename, group
+import sys
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg2.pool import ThreadedConnectionPool
+from config.settings import param, path, filename, watermark_filename, \
+    aact_workers, aact_stream, aact_batch_rows
+from ctd_processing.store import load_table, write_table, apply_deltas, \
+    delta_path, new_segment, close_segment, clear_deltas
 
 
 queries = {
@@ -55,7 +62,7 @@ queries = {
               FROM brief_summaries
               """,
            
-    "q_8":"""SELECT nct_id, title,  description,
+    "q_8":"""SELECT nct_id, title,  description
               FROM design_groups
               """,
            
@@ -66,45 +73,292 @@ queries = {
     "q_10":"""SELECT nct_id, description
              FROM detailed_descriptions
              """,
+    
+    "q_wm":"""SELECT MAX(last_update_posted_date) AS watermark
+             FROM studies
+             """,
+    
+    "q_ids":"""SELECT nct_id
+             FROM studies
+             """,
+    
+    "q_delta":"""SELECT nct_id, last_update_posted_date
+             FROM studies
+             WHERE last_update_posted_date >= %(since)s
+             """,
     }
 
 
-def q_aact(query, param):
+agg_queries = {
+    "q_3":"""SELECT nct_id, 
+              COALESCE(string_agg(DISTINCT intervention_type, E';\\n '), '') 
+                  AS intervention_type,
+              COALESCE(string_agg(DISTINCT name, E';\\n '), '') AS name,
+              COALESCE(string_agg(DISTINCT description, E';\\n '), '') 
+                  AS q_3_desc
+              FROM interventions
+              GROUP BY nct_id
+              """,
+           
+    "q_7":"""SELECT nct_id, 
+              COALESCE(string_agg(DISTINCT description, E';\\n '), '') 
+                  AS q_7_desc
+              FROM brief_summaries
+              GROUP BY nct_id
+              """,
+           
+    "q_8":"""SELECT nct_id, 
+              COALESCE(string_agg(DISTINCT title, E';\\n '), '') AS title,
+              COALESCE(string_agg(DISTINCT description, E';\\n '), '') 
+                  AS q_8_desc
+              FROM design_groups
+              GROUP BY nct_id
+              """,
+           
+    "q_9":"""SELECT nct_id, 
+              COALESCE(string_agg(DISTINCT measure, E';\\n '), '') AS measure,
+              COALESCE(string_agg(DISTINCT description, E';\\n '), '') 
+                  AS q_9_desc
+              FROM design_outcomes
+              GROUP BY nct_id
+              """,
+           
+    "q_10":"""SELECT nct_id, 
+              COALESCE(string_agg(DISTINCT description, E';\\n '), '') 
+                  AS q_10_desc
+              FROM detailed_descriptions
+              GROUP BY nct_id
+              """,
+    }
+
+
+def q_aact(query, param, params = None, pool = None):
     try:
-        conn = psycopg2.connect(**param)
-        df = pd.read_sql(query, conn)
+        conn = pool.getconn() if pool is not None else psycopg2.connect(**param)
+        
+        try:
+            df = pd.read_sql(query, conn, params = params)
+        
+        finally:
+            _release(conn, pool)
         
         return df
     
     except Exception as e:
         print(f"Erroneous Request: {e}")
+        
+        raise
 
 
-d_CTD = {}
-d_CTD[f"{filename}_6"] = q_aact(queries['q_6'], param)
+def q_stream(query, param, f_path, pool = None, batch_rows = aact_batch_rows):
+    try:
+        conn = pool.getconn() if pool is not None else psycopg2.connect(**param)
+        tmp_path = f"{f_path}.part"
+        n_rows = 0
+        
+        try:
+            with conn.cursor(name = f"stream_{os.getpid()}_{id(f_path)}") \
+                    as cursor:
+                cursor.itersize = batch_rows
+                cursor.execute(query)
+                
+                while True:
+                    rows = cursor.fetchmany(batch_rows)
+                    
+                    if not rows and n_rows:
+                        break
+                    
+                    columns = [col[0] for col in cursor.description]
+                    pd.DataFrame(rows, columns = columns).to_csv(tmp_path, 
+                        mode = 'a' if n_rows else 'w', header = not n_rows, 
+                        index = False)
+                    
+                    n_rows += len(rows)
+                    
+                    if not rows:
+                        break
+            
+            os.replace(tmp_path, f_path)
+        
+        finally:
+            _release(conn, pool)
+        
+        return n_rows
+    
+    except Exception as e:
+        print(f"Erroneous Request: {e}")
+        
+        raise
+
 
-for i in range(1,11):
-    if i in list(range(1,6)):
-        d_CTD[f"{filename}_{i}"] = q_aact(queries[f"q_{i}"], param)
+def _release(conn, pool):
+    if pool is None:
+        conn.close()
         
-        d_CTD[f"{filename}_{i}"].to_csv(os.path.join(path,
-            f"{filename}_{i}.csv"), index = False)
+        return
+    
+    if not conn.closed:
+        conn.rollback()
+    
+    pool.putconn(conn)
+
+
+def q_delta(query):
+    return (f"SELECT q.* FROM ({query.strip().rstrip(';')}) q "
+            "WHERE q.nct_id = ANY(%(ids)s)")
+
+
+def aact_extract(param, ids = None, store = None, workers = aact_workers,
+                 stream_path = None):
+    d_CTD = {}
+    ctd_6 = {}
     
-    if i in [3] + list(range(7,11)):
-        print(i)
-        CTD = q_aact(queries[f"q_{i}"], param)
+    jobs = {f"{filename}_{i}": queries[f"q_{i}"] for i in range(1,6)}
+    jobs[f"{filename}_6"] = queries['q_6']
+    jobs.update({f"q_{i}": agg_queries[f"q_{i}"] for i in [3] + 
+                 list(range(7,11))})
+    
+    if ids is not None:
+        jobs = {key: q_delta(query) for key, query in jobs.items()}
+    
+    params = {'ids': list(ids)} if ids is not None else None
+    pool = ThreadedConnectionPool(1, workers, **param)
+    failed = {}
+    
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            futures = {}
+            
+            for key, query in jobs.items():
+                if stream_path is not None and ids is None and \
+                        key in aact_stream:
+                    futures[executor.submit(q_stream, query, param, 
+                        os.path.join(stream_path, f"{key}.csv"), pool)] = key
+                
+                else:
+                    futures[executor.submit(q_aact, query, param, params, 
+                        pool)] = key
+            
+            for future in as_completed(futures):
+                key = futures[future]
+                
+                if future.exception() is not None:
+                    failed[key] = future.exception()
+                    
+                    continue
+                
+                print(f"{key} extracted.")
+                
+                if stream_path is not None and ids is None and \
+                        key in aact_stream:
+                    print(f"{future.result()} rows streamed to {key}.csv.")
+                
+                elif key.startswith(filename) and key != f"{filename}_6":
+                    d_CTD[key] = future.result()
+                    
+                    if store is not None:
+                        store(key, d_CTD[key])
+                
+                else:
+                    ctd_6[key] = future.result()
+    
+    finally:
+        pool.closeall()
+    
+    if failed:
+        raise RuntimeError(f"AACT extraction failed for {sorted(failed)}.") \
+            from next(iter(failed.values()))
+    
+    d_CTD[f"{filename}_6"] = ctd_6[f"{filename}_6"]
+    
+    for i in [3] + list(range(7,11)):
+        d_CTD[f"{filename}_6"] = pd.merge(d_CTD[f"{filename}_6"], 
+            ctd_6[f"q_{i}"], on = 'nct_id', how = 'left')
+    
+    if store is not None:
+        store(f"{filename}_6", d_CTD[f"{filename}_6"])
+    
+    return d_CTD
+
+
+def aact_watermark(param):
+    return q_aact(queries['q_wm'], param)['watermark'].iloc[0]
+
+
+def aact_updated(param, since):
+    return q_aact(queries['q_delta'], param, {'since': since})
+
+
+def aact_full(param, path):
+    watermark = aact_watermark(param)
+    
+    d_CTD = aact_extract(param, store = lambda key, df: df.to_csv(
+        os.path.join(path, f"{key}.csv"), index = False), stream_path = path)
+    
+    clear_deltas(path)
+    _save_watermark(path, watermark)
+    
+    return d_CTD
+
+
+def aact_local_ids(path):
+    key = f"{filename}_6"
+    ids = load_table(path, key, os.path.join(path, f"{key}.csv"), 
+        columns = ['nct_id'])
+    
+    return apply_deltas(path, key, ids, columns = ['nct_id'])['nct_id']
+
+
+def aact_delta(param, path):
+    watermark = _load_watermark(path)
+    
+    if watermark is None:
+        print("No AACT watermark found - running full extraction.")
         
-        CTD = (CTD.groupby(group)
-                .agg(lambda series: 
-                     ';\n '.join(series.dropna().unique())).reset_index())
+        return len(aact_full(param, path)[f"{filename}_6"])
+    
+    delta = aact_updated(param, watermark)
+    ids = delta['nct_id'].dropna().unique()
+    
+    remote = q_aact(queries['q_ids'], param)['nct_id']
+    gone = set(aact_local_ids(path)) - set(remote)
+    
+    print(f"{len(ids)} trials updated and {len(gone)} withdrawn since "
+          f"{watermark}.")
+    
+    if len(ids) or gone:
+        segment = new_segment(path)
         
-        if "description" in CTD.columns:
-            CTD = CTD.rename(columns = {'description': f"q_{i}_desc"})
+        if len(ids):
+            aact_extract(param, ids, store = lambda key, df: write_table(df, 
+                delta_path(path, segment, key), key))
         
-        d_CTD[f"{filename}_6"] = pd.merge(d_CTD[f"{filename}_6"], CTD, on =
-            'nct_id', how = 'left')
-  
-d_CTD[f"{filename}_6"].to_csv(os.path.join(path, f"{filename}_6.csv"), 
-        index = False)
+        close_segment(path, segment, set(ids) | gone)
+    
+    if len(ids):
+        _save_watermark(path, str(delta['last_update_posted_date'].max()))
+    
+    return len(ids)
+
+
+def _load_watermark(path):
+    w_path = os.path.join(path, f"{watermark_filename}.json")
+    
+    if not os.path.isfile(w_path):
+        return None
+    
+    with open(w_path, 'r') as file:
+        return json.load(file)['last_update_posted_date']
 
-del CTD
+
+def _save_watermark(path, watermark):
+    with open(os.path.join(path, f"{watermark_filename}.json"), 'w') as file:
+        json.dump({'last_update_posted_date': str(watermark)}, file)
+
+
+if __name__ == "__main__":
+    if '--delta' in sys.argv:
+        aact_delta(param, path)
+    
+    else:
+        aact_full(param, path)
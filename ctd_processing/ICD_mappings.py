@@ -15,9 +15,13 @@ This module processes and maps relationships between:
 """
 
 import re
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 from config.settings import ICD10_descriptor as descriptor
+from ctd_processing.mesh_index import MeshICDIndex, cached_index
+from ctd_processing.icd_intervals import range_chapters
+from ctd_processing.icd_hierarchy import ICD10Hierarchy
 from typing import Dict, Any
 
 
@@ -42,6 +46,44 @@ def assign_icd10(descriptor, icd_code: str) -> str:
     return 'Other'
 
 
+def _code_key(prefix: str) -> int:
+    return (ord(prefix[0]) - ord('A')) * 100 + int(prefix[1:3])
+
+
+@lru_cache(maxsize = None)
+def _descriptor_index(descriptor: tuple) -> tuple:
+    ranges = sorted((_code_key(start), _code_key(end), label) 
+                    for start, end, label in descriptor)
+    
+    return (np.array([r[0] for r in ranges]), np.array([r[1] for r in ranges]),
+            np.array([r[2] for r in ranges], dtype = object))
+
+
+def classify_icd10(descriptor, codes: pd.Series) -> pd.Series:
+    starts, ends, labels = _descriptor_index(tuple(map(tuple, descriptor)))
+    
+    idx, uniques = pd.factorize(codes)
+    uniques = pd.Series(uniques, dtype = object)
+    
+    prefix = (uniques.where(uniques.map(lambda x: isinstance(x, str)), '')
+        .str.strip().str.upper().str[:3])
+    valid = prefix.str.fullmatch(r'[A-Z][0-9]{2}').to_numpy(dtype = bool)
+    
+    chars = (prefix[valid].to_numpy(dtype = 'U3').view(np.uint32)
+        .reshape(-1, 3).astype(np.int64) - [ord('A'), ord('0'), ord('0')])
+    keys = chars[:, 0] * 100 + chars[:, 1] * 10 + chars[:, 2]
+    pos = np.searchsorted(starts, keys, side = 'right') - 1
+    hit = (pos >= 0) & (keys <= ends[np.maximum(pos, 0)])
+    
+    cats = np.full(len(uniques) + 1, 'Other', dtype = object)
+    cats[np.flatnonzero(valid)[hit]] = labels[pos[hit]]
+    
+    for i in np.flatnonzero(~valid):
+        cats[i] = assign_icd10(descriptor, uniques[i])
+    
+    return pd.Series(cats[idx], index = codes.index)
+
+
 def clean_icd(code: str) -> str:
     return re.sub(r'\..*', '', str(code))
 
@@ -78,85 +120,49 @@ def _proc_micd(data: Dict[str, Any]) -> Dict[str, Any]:
     return data
 
 
-def _merge_maps(data: Dict[str, Any]) -> Dict[str, Any]:
-    data['MMap'] = pd.merge(
-        data['MICD'], 
-        data['Map_3'], 
-        on=['MESH_id'], 
-        how='left'
-    )
-    
-    data['MMap']['ICD10CM_id_y'] = np.where(
-        data['MMap']['ICD10CM_id_y'].isna(), 
-        data['MMap']['ICD10CM_id_x'], 
-        data['MMap']['ICD10CM_id_y']
-    )
-    
-    data['MMap'] = (data['MMap']
-        .rename(columns={'ICD10CM_id_y': 'ICD10CM_id'}))
-    
-    data['MMap'] = pd.merge(
-        data['MMap'], 
-        data['Map_3'], 
-        on=['ICD10CM_id'], 
-        how='left'
-    )
+def _build_index(data: Dict[str, Any]) -> MeshICDIndex:
+    if 'Map_3' not in data:
+        data = _proc_maps(data)
     
-    data['MMap'] = (data['MMap']
-        .drop(columns=['ICD10CM_id_x', 'MESH_id_x']))
-    data['MMap']['MESH_term'] = data['MMap']['MESH_term'].str.lower()
+    data = _proc_micd(data)
     
-    data['MMap'] = data['MMap'].groupby('MESH_term').agg(
-        ICD10CM_id=('ICD10CM_id', lambda x: list(set(x))),    
-        MESH_id=('MESH_id_y', lambda x: list(set(x)))
-    ).reset_index()
-    
-    return data
+    return MeshICDIndex.build(data['MICD'], data['Map_3'])
 
 
-def _merge_mesh(data: Dict[str, Any]) -> Dict[str, Any]:
-    data['CTD_5'].columns = ['NCT_id', 'MESH_term']
-    data['CTD_5']['MESH_term'] = (data['CTD_5']['MESH_term']
-        .str.lower())
-    
-    data['MMap'] = pd.merge(
-        data['MMap'], 
-        data['CTD_5'], 
-        on='MESH_term', 
-        how='left'
-    )
-    
-    data['MMap'] = data['MMap'].groupby('NCT_id').agg(
-        MESH_term = ('MESH_term', list),
-        ICD10CM_id = ('ICD10CM_id', lambda x: [item for sublist in x 
-            for item in sublist]),  
-        MESH_id = ('MESH_id', lambda x: [item for sublist in x 
-            for item in sublist]),  
-    ).reset_index()
-    
-    data['MMap']['MESH_term_ct'] = data['MMap']['MESH_term'].apply(len)    
-    data['MMap']['ICD10CM_ct'] = data['MMap']['ICD10CM_id'].apply(len)
-    data['MMap']['MESH_id_ct'] = data['MMap']['MESH_id'].apply(len)
-    
-    data['MMap'] = data['MMap'].iloc[:, [0, 2]]
-    data['MMap'].columns = ['NCT_id', 'ICD10']
-    
-    data['MMap'] = data['MMap'].explode('ICD10')
+def _mesh_icd10(data: Dict[str, Any], path: str) -> Dict[str, Any]:
+    data['MMap'] = (cached_index(path, lambda: _build_index(data))
+        .apply(data['CTD_5']))
     
     data['MMap'] = data['MMap'][data['MMap']['ICD10'] != 'nan']
-    data['MMap']['clinical_cat'] = (data['MMap']['ICD10']
-        .apply(lambda x: assign_icd10(descriptor, x)))
+    data['MMap']['clinical_cat'] = classify_icd10(descriptor, 
+        data['MMap']['ICD10'])
     
     return data
 
 
 def _proc_UMLSicd10(data: Dict[str, Any], path: str) -> Dict[str, Any]:
     data['dht_icd10'].columns = ['NCT_id', 'ICD10']
+    spans = range_chapters(descriptor, data['dht_icd10']['ICD10']
+        .astype(str))
     data['dht_icd10']['ICD10'] = (data['dht_icd10']['ICD10']
         .astype(str)
         .apply(clean_icd))
-    data['dht_icd10']['clinical_cat'] = (data['dht_icd10']['ICD10']
-        .apply(lambda x: assign_icd10(descriptor, x)))
+    data['dht_icd10']['clinical_cat'] = classify_icd10(descriptor, 
+        data['dht_icd10']['ICD10'])
+    data['dht_icd10']['clinical_cat'] = (spans.where(spans.notna(), 
+        data['dht_icd10']['clinical_cat']))
+    data['dht_icd10'] = data['dht_icd10'].explode('clinical_cat')
+    
+    return data
+
+
+def _rollup_icd10(data: Dict[str, Any]) -> Dict[str, Any]:
+    hierarchy = ICD10Hierarchy(descriptor, data['icd10_blocks'])
+    
+    data['ICD_rollup'] = hierarchy.rollup(pd.concat([data['MMap'], 
+        data['dht_icd10']], ignore_index = True)[['NCT_id', 'ICD10']]
+        .drop_duplicates())
+    data['ICD_levels'] = hierarchy.levels()
     
     return data
 
@@ -178,11 +184,12 @@ def _comb_icd10(data: Dict[str, Any]) -> Dict[str, Any]:
 
 
 def icd10_maps(d_CTD: Dict[str, Any], path: str) -> Dict[str, Any]:
-    d_CTD = _proc_maps(d_CTD)
-    d_CTD = _proc_micd(d_CTD)
-    d_CTD = _merge_maps(d_CTD)
-    d_CTD = _merge_mesh(d_CTD)
+    d_CTD = _mesh_icd10(d_CTD, path)
     d_CTD = _proc_UMLSicd10(d_CTD, path)
+    
+    if 'icd10_blocks' in d_CTD:
+        d_CTD = _rollup_icd10(d_CTD)
+    
     d_CTD = _comb_icd10(d_CTD)
     
     return d_CTD
\ No newline at end of file
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Offline AACT extraction from a monthly pipe-delimited flat-file snapshot
+
+Builds the same CTD_1..6 tables as the queries in AACT_queries.py, reading
+only the required columns of each table file in chunks and performing the
+joins and aggregations locally. Text and sponsor tables are reduced chunk
+by chunk (unique nct_id / text pairs, unique rows) before concatenation.
+"""
+
+import os
+import sys
+import pandas as pd
+from config.settings import path, filename, aact_batch_rows, aact_snapshot
+from ctd_processing.store import clear_deltas
+
+
+flat_columns = {
+    'studies': ['nct_id', 'study_type', 'is_fda_regulated_drug',
+                'is_fda_regulated_device', 'is_unapproved_device',
+                'overall_status', 'enrollment', 'start_date',
+                'completion_date', 'phase', 'number_of_arms',
+                'official_title'],
+    'eligibilities': ['nct_id', 'sampling_method', 'gender', 'minimum_age',
+                      'maximum_age'],
+    'countries': ['nct_id', 'name'],
+    'calculated_values': ['nct_id', 'were_results_reported'],
+    'baseline_counts': ['nct_id', 'ctgov_group_code', 'count'],
+    'baseline_measurements': ['nct_id', 'ctgov_group_code', 'classification',
+                              'category', 'title', 'units', 'param_type',
+                              'param_value_num'],
+    'interventions': ['nct_id', 'intervention_type', 'name', 'description'],
+    'sponsors': ['nct_id', 'agency_class', 'lead_or_collaborator'],
+    'browse_conditions': ['nct_id', 'mesh_term'],
+    'brief_summaries': ['nct_id', 'description'],
+    'design_groups': ['nct_id', 'title', 'description'],
+    'design_outcomes': ['nct_id', 'measure', 'description'],
+    'detailed_descriptions': ['nct_id', 'description']
+}
+
+flat_text = {
+    'q_3': ('interventions', {'intervention_type': 'intervention_type',
+            'name': 'name', 'description': 'q_3_desc'}),
+    'q_7': ('brief_summaries', {'description': 'q_7_desc'}),
+    'q_8': ('design_groups', {'title': 'title', 'description': 'q_8_desc'}),
+    'q_9': ('design_outcomes', {'measure': 'measure',
+            'description': 'q_9_desc'}),
+    'q_10': ('detailed_descriptions', {'description': 'q_10_desc'})
+}
+
+
+def read_flat(snapshot, table, batch_rows = aact_batch_rows, reduce = None):
+    f_path = os.path.join(snapshot, f"{table}.txt")
+
+    chunks = (chunk[flat_columns[table]] for chunk in pd.read_csv(f_path,
+        sep = '|', usecols = flat_columns[table], chunksize = batch_rows,
+        low_memory = False))
+
+    if reduce is not None:
+        chunks = map(reduce, chunks)
+
+    return pd.concat(chunks, ignore_index = True)
+
+
+def text_pairs(df, columns):
+    return (df.melt(id_vars = 'nct_id', value_vars = list(columns),
+                    var_name = 'column', value_name = 'text')
+            .dropna(subset = ['nct_id']).drop_duplicates())
+
+
+def agg_text(pairs, columns):
+    ids = pd.Index(pairs['nct_id'].unique(), name = 'nct_id')
+    agg = pd.DataFrame(index = ids)
+
+    text = (pairs.dropna(subset = ['text']).drop_duplicates()
+            .sort_values(['column', 'nct_id', 'text']))
+    text = text.groupby(['column', 'nct_id'])['text'].agg(';\n '.join)
+
+    for col, name in columns.items():
+        agg[name] = (text[col] if col in text.index else pd.Series(
+            dtype = object)).reindex(ids).fillna('')
+
+    return agg.reset_index()
+
+
+def flat_extract(snapshot, store = None):
+    d_CTD = {}
+    tables = {}
+
+    def table(name):
+        if name not in tables:
+            print(f"Reading {name}.txt...")
+
+            tables[name] = read_flat(snapshot, name)
+
+        return tables[name]
+
+    def stored(key, df):
+        d_CTD[key] = df
+
+        if store is not None:
+            store(key, df)
+
+    studies = table('studies')
+
+    stored(f"{filename}_1", (studies.drop(columns = ['official_title'])
+        .merge(table('eligibilities'), on = 'nct_id', how = 'left')
+        .merge(table('countries'), on = 'nct_id', how = 'left')
+        .merge(table('calculated_values'), on = 'nct_id', how = 'left')))
+
+    for name in ['eligibilities', 'countries', 'calculated_values']:
+        del tables[name]
+
+    stored(f"{filename}_2", table('baseline_counts').merge(
+        table('baseline_measurements'), on = ['nct_id', 'ctgov_group_code'],
+        how = 'left'))
+
+    for name in ['baseline_counts', 'baseline_measurements']:
+        del tables[name]
+
+    stored(f"{filename}_3", table('interventions'))
+    stored(f"{filename}_4", read_flat(snapshot, 'sponsors',
+        reduce = pd.DataFrame.drop_duplicates).drop_duplicates()
+        .reset_index(drop = True))
+    stored(f"{filename}_5", table('browse_conditions'))
+
+    CTD_6 = studies[['nct_id', 'official_title']]
+
+    for name, columns in flat_text.values():
+        if name in tables:
+            pairs = text_pairs(tables.pop(name), columns)
+
+        else:
+            print(f"Reading {name}.txt...")
+
+            pairs = read_flat(snapshot, name, reduce = lambda chunk:
+                text_pairs(chunk, columns))
+
+        CTD_6 = pd.merge(CTD_6, agg_text(pairs, columns), on = 'nct_id',
+            how = 'left')
+
+    stored(f"{filename}_6", CTD_6)
+
+    return d_CTD
+
+
+def flat_full(snapshot, path):
+    d_CTD = flat_extract(snapshot, store = lambda key, df: df.to_csv(
+        os.path.join(path, f"{key}.csv"), index = False))
+
+    clear_deltas(path)
+
+    return d_CTD
+
+
+if __name__ == "__main__":
+    flat_full(sys.argv[1] if len(sys.argv) > 1 else aact_snapshot, path)
@@ -8,19 +8,29 @@ Created on Fri Nov 15 18:01:33 2024
 import os
 import time
 import json
+import hashlib
 import logging
 import pandas as pd
 from more_itertools import chunked
-from config.settings import chunks, ctdwn, openAI_Model
+from config.settings import chunks, ctdwn, openAI_Model, b_concurrent, \
+    label_cache_filename, b_manifest_filename, packed_prompt_template, \
+    pack_size, pack_retries, pre_classify
+from ctd_processing.label_cache import LabelCache
+from ctd_processing.pre_classify import PreClassifier
+
+
+b_failed = ('failed', 'expired', 'cancelled')
 
 
 class DefineTask:
-    def __init__(self, openAI_model, prompt_template):
+    def __init__(self, openAI_model, prompt_template, 
+                 packed_template = packed_prompt_template):
         logging.basicConfig(level = logging.INFO, 
             format = "%(asctime)s - %(levelname)s - %(message)s")
         
         self.model = openAI_model
         self.prompt_template = prompt_template
+        self.packed_template = packed_template
 
     def b_create(self, exp_i, cat, scat):
         logging.info("Creating batch job...")
@@ -47,6 +57,40 @@ class DefineTask:
             for i in exp_i
         ]
 
+    def b_create_packed(self, exp_i, cat, scat, pack):
+        logging.info("Creating packed batch job...")
+        
+        tasks = []
+        packs = {}
+        
+        for pack_i, exp_p in enumerate(chunked(exp_i, pack)):
+            custom_id = f"pack-{pack_i}"
+            packs[custom_id] = (cat, list(exp_p))
+            
+            exps = json.dumps([{"id": j, "exp": i} for j, i in 
+                enumerate(exp_p)], ensure_ascii = False)
+            
+            tasks.append({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "temperature": 0,
+                    "max_tokens": 50 + 40 * len(exp_p),
+                    "top_p": 1,
+                    "presence_penalty": 0,
+                    "frequency_penalty": 0,
+                    "response_format": {"type": "json_object"},
+                    "messages": [{"role": "user", "content": 
+                        self.packed_template.format(title = cat, exps = exps, 
+                        cat = scat) + 
+                        " Please respond in JSON format."}]    
+                }
+            })
+        
+        return tasks, packs
+
 
 class RetryClient:
    def __init__(self, client, retries = 3, delay = 2):
@@ -74,13 +118,63 @@ class RetryClient:
         return getattr(self.client, attr)
 
 
+class BatchManifest:
+    def __init__(self, file_name):
+        logging.basicConfig(level = logging.INFO, 
+            format = "%(asctime)s - %(levelname)s - %(message)s")
+        
+        self.file_name = file_name
+        self.entries = {}
+        
+        if os.path.isfile(file_name):
+            with open(file_name, 'r') as file:
+                self.entries = json.load(file)
+            
+            logging.info(f"Batch manifest found - {len(self.entries)} "
+                         "batches on record.")
+
+    @staticmethod
+    def digest(tasks):
+        return hashlib.sha256(json.dumps(tasks, sort_keys = True)
+            .encode('utf-8')).hexdigest()
+
+    def reattach(self, chunk, tasks_hash):
+        entry = self.entries.get(chunk)
+        
+        if (entry is not None and entry.get('tasks_hash') == tasks_hash and 
+                entry.get('batch_id') and entry.get('status') not in b_failed):
+            return entry
+        
+        return None
+
+    def record(self, chunk, **fields):
+        self.entries.setdefault(chunk, {'chunk': chunk}).update(fields)
+        self._save()
+
+    def update_batch(self, b_id, **fields):
+        for entry in self.entries.values():
+            if entry.get('batch_id') == b_id:
+                entry.update(fields)
+        
+        self._save()
+
+    def _save(self):
+        tmp_name = f"{self.file_name}.tmp"
+        
+        with open(tmp_name, 'w') as file:
+            json.dump(self.entries, file, indent = 2)
+        
+        os.replace(tmp_name, self.file_name)
+
+
 class ProcessBatch:
-    def __init__(self, client, task_creator):
+    def __init__(self, client, task_creator, manifest = None):
         logging.basicConfig(level = logging.INFO, 
             format = "%(asctime)s - %(levelname)s - %(message)s")
         
         self.client = client
         self.task_creator = task_creator
+        self.manifest = manifest
         self.b_completion_count = 0
 
     def b_submit(self, file_name, tasks):
@@ -98,16 +192,57 @@ class ProcessBatch:
                      f" to complete...")
        
         while True:
-            batch_status = self.client.batches.retrieve(b_id).status
+            batch_status = self._b_status(b_id)
         
             if batch_status == 'completed':
                 logging.info("Batch completed. Proceeding...")
                
-                break
+                return batch_status
+            
+            elif batch_status in b_failed:
+                logging.error(f"Batch {batch_status} - skipping results.")
+                
+                return batch_status
         
             else:
                 self._countdown(ctdwn)
 
+    def b_completion_all(self, b_job_dict):
+        pending = dict(b_job_dict)
+        
+        logging.info(f"\nWaiting for {len(pending)} batches to complete...")
+        
+        while pending:
+            for chunk, b_id in list(pending.items()):
+                batch_status = self._b_status(b_id)
+                
+                if batch_status == 'completed':
+                    logging.info(f"Batch {chunk} completed. Proceeding...")
+                    
+                    del pending[chunk]
+                    
+                    yield chunk, b_id
+                
+                elif batch_status in b_failed:
+                    logging.error(f"Batch {chunk} {batch_status} - "
+                                  "skipping results.")
+                    
+                    del pending[chunk]
+            
+            if pending:
+                logging.info(f"{len(pending)} batches still in progress.")
+                
+                self._countdown(ctdwn)
+
+    def _b_status(self, b_id):
+        batch = self.client.batches.retrieve(b_id)
+        
+        if self.manifest is not None:
+            self.manifest.update_batch(b_id, status = batch.status, 
+                output_file_id = batch.output_file_id)
+        
+        return batch.status
+
     def _countdown(self, minutes):
         for remaining in range(minutes * 60, 0, -1):
             mins, secs = divmod(remaining, 60)
@@ -124,7 +259,7 @@ class HandleResult:
         
         self.client = client
 
-    def process_results(self, batch_id):
+    def process_results(self, batch_id, packs = None):
         logging.info("Retrieving results...")
         
         output_file_id = self.client.batches.retrieve(batch_id).output_file_id
@@ -138,6 +273,9 @@ class HandleResult:
             for line in file:
                 json_obj = json.loads(line.strip())
                 json_df.append(json_obj)
+        
+        if packs is not None:
+            return self._extract_packed(json_df, packs)
                 
         return self._extract_json(json_df)
 
@@ -159,14 +297,37 @@ class HandleResult:
                 
         return results
 
+    def _extract_packed(self, json_df, packs):
+        results = []
+        
+        for i, row in enumerate(json_df):
+            try:
+                cat, exp_p = packs[row['custom_id']]
+                content = row['response']['body']['choices'][0]['message']['content']
+                labels = json.loads(content)['labels']
+                
+                for item in labels:
+                    j = item.get('id')
+                    
+                    if isinstance(j, int) and 0 <= j < len(exp_p):
+                        results.append((cat, exp_p[j], item.get('piv_cat')))
+                
+            except (KeyError, TypeError, AttributeError, 
+                    json.JSONDecodeError) as e:
+                print(f"Error at index {i}: {e}")
+                
+        return results
+
 
-def b_jobs(path, batch_filename, prompt_template, cat_dict, data, client):
+def b_jobs(path, batch_filename, prompt_template, cat_dict, data, client,
+           concurrent = b_concurrent, cache_filename = label_cache_filename,
+           pack = pack_size, rules = pre_classify):
     
     os.chdir(path)
     
     b_job_dict = {}
 
-    b_output = pd.DataFrame()
+    b_output = pd.DataFrame(columns = ['cat_title', 'cat_exp', 'piv_cat'])
     
     if os.path.isfile(os.path.join(path, f"{batch_filename}.csv")):
         
@@ -174,62 +335,176 @@ def b_jobs(path, batch_filename, prompt_template, cat_dict, data, client):
     
     else:
         
-        cat_exp = []
+        b_pending = {}
     
         task_creator = DefineTask(openAI_Model, prompt_template)
         retry_client = RetryClient(client)
-        batch_processor = ProcessBatch(retry_client, task_creator)
+        manifest = BatchManifest(os.path.join(path, 
+            f"{b_manifest_filename}.json"))
+        batch_processor = ProcessBatch(retry_client, task_creator, manifest)
         result_handler = HandleResult(retry_client)
+        
+        pre_classifier = None
+        label_cache = None
+        b_local = set()
+        
+        if rules:
+            pre_classifier = PreClassifier(cat_dict)
+        
+        if cache_filename:
+            label_cache = LabelCache(os.path.join(path, cache_filename), 
+                openAI_Model, packed_prompt_template if pack > 1 
+                else prompt_template)
     
         for cat, scat in cat_dict.items():
-            exp = list(set(map(str, data[(data['cat_title'] == cat)]
+            exp = sorted(set(map(str, data[(data['cat_title'] == cat)]
                 ['cat_exp'])))
             
-            cat_exp.extend(list(set(exp)))
-            
-            exp = list(chunked(exp, (len(exp) // chunks)))
-             
-            for chunk_i, exp_i in enumerate(exp, start = 1):
-                tasks = task_creator.b_create(exp_i, cat, scat)
-
-                file_name = f"{cat}_chunk_{chunk_i}.jsonl"
+            if pre_classifier is not None:
+                ruled, exp = pre_classifier.classify(cat, exp)
+                b_local.update(zip(ruled['cat_title'], ruled['cat_exp']))
                 
-                b_file = batch_processor.b_submit(file_name, tasks)
+                b_output = pd.concat([b_output, ruled], ignore_index = True)
+            
+            if label_cache is not None:
+                cached, exp = label_cache.lookup(cat, exp, scat)
+                b_local.update(zip(cached['cat_title'], cached['cat_exp']))
                 
-                b_job = client.batches.create(
-                    input_file_id = b_file.id,
-                    endpoint = "/v1/chat/completions",
-                    completion_window = "24h"
-                )
+                b_output = pd.concat([b_output, cached], ignore_index = True)
+            
+            b_pending[cat] = exp
+        
+        if pre_classifier is not None:
+            pre_classifier.report()
+        
+        for b_round in range(pack_retries + 1 if pack > 1 else 1):
+            b_round_dict = {}
+            b_packs = {}
+            b_done = {}
+            
+            for cat, scat in cat_dict.items():
+                exp = list(chunked(b_pending[cat], 
+                    max(1, -(-len(b_pending[cat]) // chunks))))
+                 
+                for chunk_i, exp_i in enumerate(exp, start = 1):
+                    chunk = (f"{cat}_chunk_{chunk_i}" if b_round == 0 else 
+                             f"{cat}_retry_{b_round}_chunk_{chunk_i}")
+                    
+                    if pack > 1:
+                        tasks, b_packs[chunk] = task_creator.b_create_packed(
+                            exp_i, cat, scat, pack)
+                    
+                    else:
+                        tasks = task_creator.b_create(exp_i, cat, scat)
+    
+                    tasks_hash = manifest.digest(tasks)
+                    entry = manifest.reattach(chunk, tasks_hash)
+                    
+                    if entry is not None:
+                        logging.info(f"Reattaching to batch {chunk} "
+                            f"({entry['batch_id']}, {entry['status']}).")
+                        
+                        b_round_dict[chunk] = entry['batch_id']
+                    
+                    else:
+                        b_file = batch_processor.b_submit(f"{chunk}.jsonl", 
+                            tasks)
+                        
+                        b_job = client.batches.create(
+                            input_file_id = b_file.id,
+                            endpoint = "/v1/chat/completions",
+                            completion_window = "24h"
+                        )
+                        
+                        manifest.record(chunk, tasks_hash = tasks_hash, 
+                            input_file_id = b_file.id, batch_id = b_job.id, 
+                            status = b_job.status, output_file_id = None)
+                        
+                        b_round_dict[chunk] = b_job.id
+                    
+                    if not concurrent and batch_processor.b_completion(
+                            b_round_dict[chunk]) == 'completed':
+                        b_done[chunk] = b_round_dict[chunk]
+            
+            b_job_dict.update(b_round_dict)
+            
+            if concurrent:
+                b_completed = batch_processor.b_completion_all(b_round_dict)
+            
+            else:
+                b_completed = b_done.items()
+                    
+            for chunk, b_id in b_completed:
+                    result = result_handler.process_results(b_id, 
+                        b_packs.get(chunk))
+    
+                    if isinstance(result, list):
+                        result = pd.DataFrame(result, 
+                            columns = ['cat_title', 'cat_exp', 'piv_cat'])
+    
+                    b_output = pd.concat([b_output, result], 
+                        ignore_index = True)
+    
+                    b_output['cat_exp'] = [
+                        tuple(item) if isinstance(item, list) else item 
+                            for item in b_output['cat_exp']
+                        ]
+                    
+                    b_output = b_output.drop_duplicates()
+            
+            if pack > 1:
+                for cat, scat in cat_dict.items():
+                    labelled = set(b_output.loc[(b_output['cat_title'] == cat) 
+                        & b_output['piv_cat'].isin(scat), 'cat_exp'])
+                    
+                    b_pending[cat] = [i for i in b_pending[cat] 
+                                      if i not in labelled]
                 
-                b_job_dict[f"{cat}_chunk_{chunk_i}"] = b_job.id
+                n_pending = sum(len(exp) for exp in b_pending.values())
                 
-                batch_processor.b_completion(b_job.id)
+                if n_pending == 0:
+                    break
                 
-        for cat, b_id in b_job_dict.items():
-                result = result_handler.process_results(b_id)
-
-                if isinstance(result, list):
-                    result = pd.DataFrame(result, 
-                        columns = ['cat_title', 'cat_exp', 'piv_cat'])
-
-                b_output = pd.concat([b_output, result], ignore_index = True)
-
-                b_output['cat_exp'] = [
-                    tuple(item) if isinstance(item, list) else item for item 
-                        in b_output['cat_exp']
-                    ]
+                elif b_round < pack_retries:
+                    logging.info(f"{n_pending} expressions dropped by the "
+                                 f"model - retry {b_round + 1}/{pack_retries}.")
+                    
+                    for cat, exp in b_pending.items():
+                        b_output = b_output[~((b_output['cat_title'] == cat) 
+                            & b_output['cat_exp'].isin(exp))]
                 
-                b_output = b_output.drop_duplicates()
+                else:
+                    logging.warning(f"{n_pending} expressions still "
+                                    "unlabelled after all retries.")
 
         b_output['cat_exp'] = [
             tuple(item) if isinstance(item, list) else item for item 
                 in b_output['cat_exp']
             ]
         
+        valid = [piv_cat in cat_dict.get(cat, ()) for cat, piv_cat in 
+                 zip(b_output['cat_title'], b_output['piv_cat'])]
+        b_output = (b_output.assign(_valid = valid)
+            .sort_values('_valid', ascending = False, kind = 'stable')
+            .drop_duplicates(['cat_title', 'cat_exp'])
+            .sort_index().drop(columns = '_valid')
+            .reset_index(drop = True))
+        
+        if label_cache is not None:
+            b_batch = b_output[[(cat, exp) not in b_local for cat, exp in 
+                zip(b_output['cat_title'], b_output['cat_exp'])]]
+            
+            for cat, scat in cat_dict.items():
+                label_cache.store(cat, scat, b_batch)
+            
+            label_cache.close()
+        
         b_output.to_csv(os.path.join(path, f"{batch_filename}.csv"), 
                 index = False)
         
+        for chunk in b_job_dict:
+            manifest.record(chunk, collected = True)
+        
         print(f"Batch job results saved as {batch_filename}.csv in {path}")
     
-    return b_output
\ No newline at end of file
+    return b_output
@@ -6,27 +6,111 @@ Created on Sun Oct 27 21:18:41 2024
 """
 
 import os
-import pandas as pd
-from config.settings import path, urls, f_list
-    
-d_CTD = {}
-
-f_exist = True
-
-for file in f_list['list_1']:
-    f_path = os.path.join(path, file)
-
-    if not os.path.isfile(f_path):
-        f_exist = False
-        
-if f_exist:
-    for files in f_list.values():
-        for file in files:
-            f_path = os.path.join(path, file)
-            d_CTD[file.split('.')[0]] = pd.read_csv(f_path)
-         
-    for key, url in urls.items():
-        d_CTD[key] = pd.read_csv(url, sep ='\t')
-    
-else:
-    from ctd_processing.AACT_queries import d_CTD
+import logging
+from collections.abc import MutableMapping
+from ctd_processing.store import load_table, apply_deltas, delta_segments
+from ctd_processing.map_cache import load_map, load_map3
+from config.settings import path, urls, f_list, param, aact_refresh, \
+    aact_snapshot
+
+
+class CTDLoader(MutableMapping):
+    def __init__(self, path = path, f_list = f_list, urls = urls,
+                 param = param, refresh = aact_refresh,
+                 snapshot = aact_snapshot):
+        logging.basicConfig(level = logging.INFO,
+            format = "%(asctime)s - %(levelname)s - %(message)s")
+
+        self.path = path
+        self.f_list = f_list
+        self.urls = urls
+        self.param = param
+        self.refresh = refresh
+        self.snapshot = snapshot
+
+        self.files = {file.split('.')[0]: os.path.join(path, file)
+                      for files in f_list.values() for file in files}
+        self.aact = [file.split('.')[0] for file in f_list['list_1']]
+        self.extracted = False
+        self.tables = {}
+
+    def extract(self):
+        if self.extracted:
+            return
+
+        f_exist = all(os.path.isfile(self.files[key]) for key in self.aact)
+
+        if not f_exist and self.snapshot:
+            from ctd_processing.aact_flatfiles import flat_full
+
+            flat_full(self.snapshot, self.path)
+
+        elif not f_exist:
+            from ctd_processing.AACT_queries import aact_full
+
+            aact_full(self.param, self.path)
+
+        elif self.refresh == 'delta':
+            from ctd_processing.AACT_queries import aact_delta
+
+            aact_delta(self.param, self.path)
+
+        self.extracted = True
+
+    def load(self, key, columns = None):
+        if key in self.aact:
+            self.extract()
+
+        if key in self.aact and delta_segments(self.path):
+            logging.info(f"Loading {key} with AACT delta segments...")
+
+            cols = (columns if columns is None or 'nct_id' in columns else
+                    ['nct_id'] + list(columns))
+            table = apply_deltas(self.path, key, load_table(self.path, key,
+                self.files[key], cols), cols)
+
+            return table if columns is None else table[list(columns)]
+
+        if key in self.files and os.path.isfile(self.files[key]):
+            logging.info(f"Loading {key}...")
+
+            return load_table(self.path, key, self.files[key], columns)
+
+        elif key in self.urls:
+            return load_map(key, self.path, self.urls)
+
+        elif key == 'Map_3':
+            return load_map3(self.path, self.urls)
+
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key not in self.tables:
+            self.tables[key] = self.load(key)
+
+        return self.tables[key]
+
+    def __setitem__(self, key, value):
+        self.tables[key] = value
+
+    def __delitem__(self, key):
+        del self.tables[key]
+
+    def __contains__(self, key):
+        return (key in self.tables or key in self.aact or key in self.urls or
+                key == 'Map_3' or
+                (key in self.files and os.path.isfile(self.files[key])))
+
+    def __iter__(self):
+        keys = list(self.tables)
+        keys += [key for key in list(self.files) + list(self.urls) +
+                 ['Map_3'] if key not in self.tables and key in self]
+
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return (f"CTDLoader(path = {self.path!r}, loaded = "
+                f"{list(self.tables)})")
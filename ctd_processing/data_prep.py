@@ -10,28 +10,40 @@ import numpy as np
 from config.settings import *
 from ctd_processing import flags
 from ctd_processing.ICD_mappings import icd10_maps
+from ctd_processing.schema import NCTInterner, compact
 flg = flags.Flagger()
 
     
+def title_index(age, gender, race, enrollment):
+    index = {}
+    
+    for cat, keywords in [('age', age), ('race', race), ('gender', gender), 
+                          ('enrollment', enrollment)]:
+        for keyword in keywords:
+            index.setdefault(keyword.lower(), cat)
+    
+    return index
+
+
 def c_title(title, age, gender, race, enrollment):
     if isinstance(title, str):
-        title_lower = title.lower()  
-        
-        if title_lower in (keyword.lower() for keyword in age):
-            return 'age'
-        
-        elif title_lower in (keyword.lower() for keyword in race):
-            return 'race'
-        
-        elif title_lower in (keyword.lower() for keyword in gender):
-            return 'gender'
-        
-        elif title_lower in (keyword.lower() for keyword in enrollment):
-            return 'enrollment'
+        return title_index(age, gender, race, enrollment).get(title.lower(), 
+            'unknown')
         
     return 'unknown'
 
 
+def c_titles(titles, age, gender, race, enrollment):
+    index = title_index(age, gender, race, enrollment)
+    codes, uniques = pd.factorize(titles)
+    
+    cats = np.array([index.get(title.lower(), 'unknown') if isinstance(
+        title, str) else 'unknown' for title in uniques] + ['unknown'], 
+        dtype = object)
+    
+    return pd.Series(cats[codes], index = titles.index)
+
+
 def data_prep1(d_CTD): 
     max_count = d_CTD['CTD_2'].groupby('nct_id')['count'].transform('max')
     d_CTD['CTD_2'] = d_CTD['CTD_2'][d_CTD['CTD_2']['count'] == max_count] \
@@ -41,8 +53,8 @@ def data_prep1(d_CTD):
     
     
 def data_prep2(d_CTD, age, gender, race, enrollment):    
-    d_CTD['CTD_2'].loc[:,'cat_title'] = d_CTD['CTD_2']['title'] \
-        .apply(c_title, args = (age, gender, race, enrollment))
+    d_CTD['CTD_2'].loc[:,'cat_title'] = c_titles(d_CTD['CTD_2']['title'], 
+        age, gender, race, enrollment)
     d_CTD['CTD_2'] = d_CTD['CTD_2'][d_CTD['CTD_2']['cat_title'] != 'unknown']
     d_CTD['CTD_2'].loc[:,'nan_status'] = np.select(
         [
@@ -74,6 +86,13 @@ def data_prep2(d_CTD, age, gender, race, enrollment):
 
 
 def merge(d_CTD):
+    keys = ['CTD_1', 'CTD_2', 'CTD_3', 'CTD_4']
+    ids = NCTInterner().fit(*[d_CTD[key]['nct_id'] for key in keys])
+    
+    for key in keys:
+        d_CTD[key] = compact(ids.encode_frame(d_CTD[key], 'nct_id'), 
+            enum_columns.get(key, []))
+    
     d_CTD['CTD_1']['start_date'] = pd.to_datetime(d_CTD['CTD_1']['start_date'], 
         errors ='coerce').dt.strftime('%m-%d-%Y')
     d_CTD['CTD_1']['start_year'] = pd.to_datetime(d_CTD['CTD_1']['start_date'], 
@@ -138,13 +157,17 @@ def merge(d_CTD):
 
         
     d_CTD['_dta'] = d_CTD['CTD_6'].rename(columns = {'nct_id': 'NCT_id'})  
-    sample = np.random.choice(d_CTD['_dta']['NCT_id'], size = 1500, #
-        replace = False) #
-    d_CTD['_dta'] = d_CTD['_dta'][d_CTD['_dta']['NCT_id'].isin(sample)] #
+    
+    if dflg_sample is not None:
+        sample = np.random.choice(d_CTD['_dta']['NCT_id'], size = dflg_sample,
+            replace = False)
+        d_CTD['_dta'] = d_CTD['_dta'][d_CTD['_dta']['NCT_id'].isin(sample)]
+    
     flags = d_CTD['u_flags'].iloc[:, 0].tolist()
     
     d_CTD['_DHT_flags'] = flg.DHT_flag(d_CTD['_dta'], flags, dflg_colname, 
-                     dflg_columns, path, dflg_filename)
+                     dflg_columns, path, dflg_filename, engine = dflg_engine,
+                     workers = dflg_workers)
     d_CTD['_DHT_flags']['_idx'] = ((d_CTD['_DHT_flags']['_name'] != 'no matches')
         .astype(int))
     
@@ -158,7 +181,8 @@ def merge(d_CTD):
         .astype(int))
 
 
-    d_CTD['_DHT_flags'] = d_CTD['_DHT_flags'].iloc[:, [0,21,24]]
+    d_CTD['_DHT_flags'] = ids.encode_frame(d_CTD['_DHT_flags']
+        .iloc[:, [0,21,24]])
     
     d_CTD['CTD_1'] = pd.merge(d_CTD['CTD_1'], d_CTD['_DHT_flags'], 
         on = 'NCT_id', how = 'left')
@@ -179,6 +203,7 @@ def merge(d_CTD):
         how = 'left')
     
     d_CTD = icd10_maps(d_CTD, path)
+    d_CTD['ICD'] = ids.encode_frame(d_CTD['ICD'])
     
     d_CTD['CTD_1'] = pd.merge(d_CTD['CTD_1'], d_CTD['ICD'], on = 'NCT_id', 
         how = 'left')
@@ -220,23 +245,30 @@ def merge(d_CTD):
     d_CTD['CTD_2'] = d_CTD['CTD_2'][d_CTD['CTD_2']['piv_cat'].notnull()]
     d_CTD['CTD_2_agg'] = d_CTD['CTD_2'][d_CTD['CTD_2']
         ['cat_title'].isin(['race', 'gender', 'age'])] \
-            .groupby(['nct_id', 'piv_cat'], as_index = False)['piv_val'].sum()
-    d_CTD['CTD_2'] = d_CTD['CTD_2'].loc[d_CTD['CTD_2']
-        ['cat_title'] == 'enrollment', ['nct_id', 'piv_cat', 'piv_val']]
+            .groupby(['nct_id', 'piv_cat'])['piv_val'].sum() \
+            .pipe(pd.to_numeric, errors = 'coerce')
+    
+    # enrollment rows reported as MEAN/MEDIAN keep their piv_cat column;
+    # values sharing a cell with a demographic sum are kept as a list
+    _enroll = d_CTD['CTD_2'][d_CTD['CTD_2']['cat_title'] == 'enrollment']
+    _param = _enroll[_enroll['piv_cat'] != 'enrollment'] \
+        .groupby(['nct_id', 'piv_cat'])['piv_val'].agg(list)
+    
+    _cols = d_CTD['CTD_2_agg'].index.get_level_values('piv_cat') \
+        .isin(_param.index.get_level_values('piv_cat'))
+    
+    _param = pd.concat([d_CTD['CTD_2_agg'][_cols].map(lambda val: [val]),
+        _param]).groupby(level = ['nct_id', 'piv_cat']).sum() \
+        .map(lambda val: val[0] if len(val) == 1 else val)
+    d_CTD['CTD_2_agg'] = pd.concat([d_CTD['CTD_2_agg'][~_cols]
+        .unstack('piv_cat'), _param.astype(object).unstack('piv_cat')], 
+        axis = 1)
+    d_CTD['CTD_2'] = _enroll[_enroll['piv_cat'] == 'enrollment'] \
+        .groupby('nct_id')['piv_val'].agg(list).rename('enrollment')
     d_CTD['CTD_2'] = pd.concat([d_CTD['CTD_2_agg'], d_CTD['CTD_2']], 
-        ignore_index = True, axis = 0)
-    
-    d_CTD['CTD_2'] = d_CTD['CTD_2'].pivot_table(index ='nct_id', 
-        columns ='piv_cat', values = 'piv_val', aggfunc = list)
-
-
-    d_CTD['CTD_2'].reset_index(inplace = True)
-            
-    
-    d_CTD['CTD_2'].loc[:, d_CTD['CTD_2'].columns != 'enrollment'] = \
-        d_CTD['CTD_2'].loc[:, d_CTD['CTD_2'].columns != 'enrollment'] \
-        .apply(lambda col: col.apply(lambda val: val[0] if isinstance(
-        val, list) and len(val) == 1 else val))       
+        axis = 1).sort_index()
+    d_CTD['CTD_2'] = d_CTD['CTD_2'][sorted(d_CTD['CTD_2'].columns)] \
+        .rename_axis('nct_id').reset_index()
       
                                           
     d_CTD['CTD_2'].columns = ['NCT_id','<18 years', '>65 years', 'am_Indian', 
@@ -258,12 +290,6 @@ def merge(d_CTD):
         .any(axis = 1), 1, 0)
     
   
-    col = ['Male','Female','<18 years', '18:65 years', '>65 years', 
-           'am_Indian', 'Hawaian', 'White', 'Black', 'Hispanic','Asian']
-    d_CTD['CTD'][col] = d_CTD['CTD'][col].apply(lambda col: pd.to_numeric(col, 
-            errors = 'coerce'))
-
-
     d_CTD['CTD']['Enrollment'] = d_CTD['CTD']['Enrollment'].replace(0, np.nan)
     
     
@@ -318,4 +344,6 @@ def merge(d_CTD):
             'Perc_Black', 'Perc_Other', 'Perc_Hispanic', 'Perc_Asian']] \
             .sum(axis=1).between(0, 100)
     
+    d_CTD['CTD'] = ids.decode_frame(d_CTD['CTD'])
+    
     return(d_CTD['CTD'])
@@ -11,61 +11,71 @@ class Flagger():
         import re
         import pandas as pd
         import os
+        import ast
+        import json
+        import hashlib
         import numpy as np
-        from collections import Counter
+        from concurrent.futures import ProcessPoolExecutor
+        from ctd_processing.matcher import KeywordMatcher
+        from ctd_processing.incidence import KeywordIncidence
+        from ctd_processing import store
         
         self.logging = logging
         self.re = re
         self.pd = pd
         self.os = os
+        self.ast = ast
+        self.json = json
+        self.hashlib = hashlib
         self.np = np
-        self.Counter = Counter
+        self.KeywordIncidence = KeywordIncidence
+        self.KeywordMatcher = KeywordMatcher
+        self.store = store
+        self.ProcessPoolExecutor = ProcessPoolExecutor
         
         logging.basicConfig(level=logging.INFO,
                             format="%(asctime)s - %(levelname)s - %(message)s")
     
-    def DHT_search(self, data, flags, colname, columns, dummies = 'No'):
+    def DHT_search(self, data, flags, colname, columns, dummies = 'No', 
+                   engine = 'automaton', workers = 1, id_col = 'NCT_id',
+                   empty = None):
         self.logging.info("Flagging data...")
         
-        lc_flags = list(set([kw.lower().strip() for kw in flags]))
+        lc_flags = sorted(set([kw.lower().strip() for kw in flags]) - {''}, 
+            key = len, reverse = True)
         
-        pattern = (r'\b(' + '|'.join([self.re.escape(kw) for kw in 
-            lc_flags]) + r')\b')
-        regex = self.re.compile(pattern, self.re.IGNORECASE)  
+        if engine == 'automaton':
+            matcher = self.KeywordMatcher(lc_flags)
+            
+        else:
+            pattern = (r'\b(' + '|'.join([self.re.escape(kw) for kw in 
+                lc_flags]) + r')\b')
+            matcher = self.re.compile(pattern, self.re.IGNORECASE)
         
-        temp_data = data.copy()
+        if empty is None:
+            empty = [col for col in columns if not data[col].notna().any()]
         
-        for col in columns:
-            self.logging.info(f"... searching '{col}' column...")
-            
-            if not temp_data[col].notna().any():
-                temp_data[f"_{col}"] = 'no matches'
-                continue
-                
-            temp_data[col] = temp_data[col].astype(str).replace({'nan': ''})
-            
-            matches = temp_data[col].apply(
-                (lambda x: list(set([m.lower() for m in 
-                    regex.findall(x)])) if self.pd.notnull(x) and 
-                    x != '' else []))
+        workers = workers or self.os.cpu_count() or 1
+        shards = self._shards(data, id_col, workers) if workers > 1 else []
+        
+        if len(shards) > 1:
+            self.logging.info(f"... searching {len(shards)} shards on "
+                              f"{workers} processes...")
             
-            temp_data[f"_{col}"] = (matches
-                .apply(lambda x: x if x else 'no matches'))
+            with self.ProcessPoolExecutor(max_workers = workers, 
+                    initializer = _init_worker, 
+                    initargs = (matcher,)) as pool:
+                results = list(pool.map(_search_shard, 
+                    [(data.iloc[pos], flags, colname, columns, dummies, empty) 
+                     for pos in shards]))
             
-            if dummies == "Yes":
-                for kw in flags:
-                    kw_lower = kw.lower()
-                    temp_data[f"_{kw.replace(' ', '_')}"] = matches.apply(
-                        lambda x: 1 if kw_lower in x else 0)
+            temp_data = self.pd.concat(results)
+            temp_data = temp_data.iloc[self.np.argsort(
+                self.np.concatenate(shards), kind = 'stable')]
         
-        temp_data[colname] = (temp_data[[f"_{col}" for col in columns]]
-            .apply(lambda row: 1 if 
-                any(isinstance(v, list) and v for v in row) else 0, axis=1))
-        
-
-        temp_data['DHT_searched_text'] = (temp_data[columns]
-            .astype(str) \
-            .apply(lambda row: ' | '.join(row), axis=1))
+        else:
+            temp_data = _search_frame(data.copy(), matcher.findall, flags, 
+                colname, columns, dummies, empty)
         
         if dummies == "No":
             self.logging.info("Dummy variables omitted.")
@@ -73,55 +83,239 @@ class Flagger():
         for col in temp_data.columns:
             if col not in data.columns:
                 data[col] = temp_data[col]
+        
+        if dummies == "Sparse":
+            self.logging.info("Dummy variables returned as sparse incidence "
+                              "matrix.")
+            
+            return data, self.KeywordIncidence.from_frame(temp_data, columns, 
+                lc_flags, id_col)
                 
         return data
     
+    def _shards(self, data, id_col, workers):
+        if id_col in data.columns:
+            codes = self.pd.factorize(data[id_col], sort = True)[0]
+        
+        else:
+            codes = self.np.arange(len(data))
+        
+        n_shards = min(workers * 4, codes.max() + 1 if len(codes) else 0)
+        
+        if n_shards < 2:
+            return []
+        
+        shard = codes % n_shards
+        
+        return [self.np.flatnonzero(shard == i) for i in range(n_shards)]
+    
     
-    def DHT_flag(self, data, flags, colname, columns, path, filename):
+    def _read_flags(self, f_path, columns):
+        _Cache = self.pd.read_csv(f_path)
+        
+        for col in columns:
+            _Cache[f"_{col}"] = _Cache[f"_{col}"].map(
+                lambda x: self.ast.literal_eval(x) if isinstance(x, str) 
+                and x.startswith('[') else x)
+        
+        return _Cache
+    
+    def DHT_flag(self, data, flags, colname, columns, path, filename, 
+                 engine = 'automaton', workers = 1, id_col = 'NCT_id'):
         self.logging.info("Checking if flags already exist...")
 
-        _Flags = self.pd.DataFrame()
+        f_path = self.os.path.join(path, f"{filename}.csv")
+        i_path = self.os.path.join(path, f"{filename}_index.csv")
+        k_path = self.os.path.join(path, f"{filename}_keys.json")
+        c_path = self.store.cache_path(path, filename)
+        
+        flag_cols = [f"_{col}" for col in columns] + [colname, 
+            'DHT_searched_text']
+        
+        lc_flags = sorted(set([kw.lower().strip() for kw in flags]) - {''})
+        keys_hash = self.hashlib.sha256('\n'.join(lc_flags)
+            .encode('utf-8')).hexdigest()[:16]
+        text_hash = (self.pd.util.hash_pandas_object(data[columns]
+            .astype(str), index = False).map('{:016x}'.format))
+        
+        _Cache = self.pd.DataFrame(columns = [id_col] + flag_cols)
+        _Index = self.pd.DataFrame(columns = [id_col, '_text_hash', 
+            '_keys_hash'])
+        keys = {}
+        
+        if all(self.os.path.isfile(f) for f in (f_path, i_path, k_path)):
+            _Cache = self.store.load_table(path, filename, f_path, 
+                reader = lambda f: self._read_flags(f, columns))
+            _Index = self.pd.read_csv(i_path, dtype = str)
+            
+            with open(k_path, 'r') as file:
+                keys = self.json.load(file)
+        
+        elif self.os.path.isfile(f_path):
+            self.logging.info("Flags without text index found - rescanning.")
+        
+        _Cache = _Cache.drop_duplicates(id_col, keep = 'last') \
+            .set_index(id_col)
+        _Index = _Index.drop_duplicates(id_col, keep = 'last') \
+            .set_index(id_col)
+        
+        stale = (data[id_col].map(_Index['_text_hash']) != text_hash).to_numpy()
+        stale |= ~data[id_col].isin(_Cache.index).to_numpy()
+        
+        old_keys = data[id_col].map(_Index['_keys_hash'])
+        
+        for old_hash in old_keys[~stale].unique():
+            if old_hash == keys_hash:
+                continue
+            
+            rows = (~stale) & (old_keys == old_hash).to_numpy()
+            
+            if old_hash not in keys:
+                stale |= rows
+                continue
+            
+            added = set(lc_flags) - set(keys[old_hash])
+            removed = set(keys[old_hash]) - set(lc_flags)
+            
+            if added:
+                search = self.KeywordMatcher(added).findall
+                stale[rows] |= (data.loc[rows, columns].map(
+                    lambda x: self.pd.notnull(x) and bool(search(str(x))))
+                    .any(axis = 1).to_numpy())
+            
+            if removed:
+                found = _Cache.loc[data.loc[rows, id_col], 
+                    [f"_{col}" for col in columns]].map(
+                    lambda x: isinstance(x, list) and bool(removed & set(x)))
+                stale[rows] |= found.any(axis = 1).to_numpy()
+        
+        self.logging.info(f"{int(stale.sum())} of {len(data)} trials new, "
+                          "edited or affected by keyword changes - "
+                          "rescanning...")
+        
+        _Fresh = data[~stale].join(_Cache[flag_cols], on = id_col)
+        
+        if stale.any():
+            _New = self.DHT_search(data[stale].copy(), flags, colname, 
+                columns, engine = engine, workers = workers, id_col = id_col,
+                empty = [col for col in columns if not data[col].notna()
+                         .any()])
         
-        if self.os.path.isfile(self.os.path.join(path, f"{filename}.csv")):
-             _Flags = self.pd.read_csv(f"{filename}.csv")
-             
-             self.logging.info(f"{colname} flags already exist - "
-                               "continuing...")
+        else:
+            _New = _Fresh.iloc[:0]
+        
+        pos = self.np.arange(len(data))
+        _Flags = self.pd.concat([_Fresh, _New])
+        _Flags = _Flags.iloc[self.np.argsort(self.np.concatenate(
+            [pos[~stale], pos[stale]]), kind = 'stable')]
+        
+        if stale.any() or not self.os.path.isfile(f_path):
+            _Cache = _Cache[~_Cache.index.isin(data[id_col])].reset_index()
+            _Cache = self.pd.concat([_Cache, _Flags], ignore_index = True)
+            _Cache = _Cache[list(_Flags.columns) + [col for col in 
+                _Cache.columns if col not in _Flags.columns]]
+            _Cache.to_csv(f_path, index = False)
+            
+            if self.store.available():
+                self.store.write_table(_Cache, c_path, filename)
+            
+            _Index = _Index[~_Index.index.isin(data[id_col])].reset_index()
+            _Index = self.pd.concat([_Index, self.pd.DataFrame({
+                id_col: data[id_col].to_numpy(), 
+                '_text_hash': text_hash.to_numpy(), 
+                '_keys_hash': keys_hash})], ignore_index = True)
+            _Index.to_csv(i_path, index = False)
+            
+            keys[keys_hash] = lc_flags
+            keys = {k: v for k, v in keys.items() 
+                    if k in set(_Index['_keys_hash'])}
+            
+            with open(k_path, 'w') as file:
+                self.json.dump(keys, file)
         
         else:
-            self.logging.info("Flags do not exist - preparing data...")
-            
-            _Flags = self.DHT_search(data, flags, colname, columns)
-            _Flags.to_csv(self.os.path.join(path,f"{filename}.csv"), 
-                index = False)
-            
-            all_matches = []
-            
-            for col in columns:
-                for item in _Flags[f"_{col}"]:
-                    if item != 'no matches':
-                        all_matches.extend([s.strip() for s in item])
-                    
-            counter = self.Counter(all_matches)
-            
-            _Counts = self.pd.DataFrame(counter.items(), 
-                columns = ['Element', 'Count'])
-            _Counts.to_csv(f"c{filename}.csv", index = False)
-            
-            self.logging.info(f"c{filename}.csv saved to {path} for visual "
-                         "inspection of false positives.")
-            
-            _Matches = _Flags[_Flags[colname] == 1]
-            _Matches = (_Flags[_Flags
-                            .columns[_Flags
-                                .columns
-                                .str
-                                .startswith('_')]
-                            .tolist()
-                            + ['DHT_searched_text']])
-            _Matches.to_csv(f"m{filename}.csv", index = False)
-            
-            self.logging.info(f"m{filename}.csv saved to {path} for visual " 
-                         "inspection of false positives.")
-        
-        return _Flags
\ No newline at end of file
+            self.logging.info(f"{colname} flags already exist - "
+                              "continuing...")
+            
+            return _Flags
+        
+        incidence = self.KeywordIncidence.from_frame(_Flags, columns, 
+            lc_flags, id_col)
+        incidence.save(self.os.path.join(path, f"{filename}_incidence.npz"))
+        
+        _Counts = (incidence.frequency().rename_axis('Element')
+            .reset_index(name = 'Count'))
+        _Counts.to_csv(f"c{filename}.csv", index = False)
+        
+        self.logging.info(f"c{filename}.csv saved to {path} for visual "
+                     "inspection of false positives.")
+        
+        _Matches = _Flags[_Flags[colname] == 1]
+        _Matches = (_Flags[_Flags
+                        .columns[_Flags
+                            .columns
+                            .str
+                            .startswith('_')]
+                        .tolist()
+                        + ['DHT_searched_text']])
+        _Matches.to_csv(f"m{filename}.csv", index = False)
+        
+        self.logging.info(f"m{filename}.csv saved to {path} for visual " 
+                     "inspection of false positives.")
+        
+        return _Flags
+
+
+def _search_frame(temp_data, search, flags, colname, columns, dummies, empty):
+    import logging
+    import pandas as pd
+    
+    for col in columns:
+        logging.info(f"... searching '{col}' column...")
+        
+        if col in empty:
+            temp_data[f"_{col}"] = 'no matches'
+            continue
+            
+        temp_data[col] = temp_data[col].astype(str).replace({'nan': ''})
+        
+        matches = temp_data[col].apply(
+            (lambda x: list(set([m.lower() for m in 
+                search(x)])) if pd.notnull(x) and 
+                x != '' else []))
+        
+        temp_data[f"_{col}"] = (matches
+            .apply(lambda x: x if x else 'no matches'))
+        
+        if dummies == "Yes":
+            for kw in flags:
+                kw_lower = kw.lower()
+                temp_data[f"_{kw.replace(' ', '_')}"] = matches.apply(
+                    lambda x: 1 if kw_lower in x else 0)
+    
+    temp_data[colname] = (temp_data[[f"_{col}" for col in columns]]
+        .apply(lambda row: 1 if 
+            any(isinstance(v, list) and v for v in row) else 0, axis=1))
+    
+
+    temp_data['DHT_searched_text'] = (temp_data[columns]
+        .astype(str) \
+        .apply(lambda row: ' | '.join(row), axis=1))
+    
+    return temp_data
+
+
+_worker_matcher = None
+
+
+def _init_worker(matcher):
+    global _worker_matcher
+    
+    _worker_matcher = matcher
+
+
+def _search_shard(args):
+    shard, flags, colname, columns, dummies, empty = args
+    
+    return _search_frame(shard.copy(), _worker_matcher.findall, flags, colname, 
+        columns, dummies, empty)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+ICD-10 chapter / block / category hierarchy
+
+Every three-character category A00..Z99 is a slot in a 2,600-slot code
+space (letter * 100 + number). chapter_of and block_of are int16 arrays
+over that space, filled once from ICD10_descriptor and Data/icd10_blocks.csv,
+so plain codes roll up with one array take. Range codes are resolved
+through the block interval tree and yield one row per spanned block.
+Unassigned levels are coded -1.
+"""
+
+import numpy as np
+import pandas as pd
+from ctd_processing.icd_intervals import block_tree, code_key, key_code, \
+    parse_range
+
+
+n_slots = 26 * 100
+
+
+class ICD10Hierarchy:
+    def __init__(self, descriptor, blocks):
+        self.chapters = [label for _, _, label in descriptor]
+        self.blocks = blocks[['start', 'end', 'label']].reset_index(drop = True)
+
+        self.chapter_of = np.full(n_slots, -1, dtype = np.int16)
+        self.block_of = np.full(n_slots, -1, dtype = np.int16)
+
+        for i, (start, end, _) in enumerate(descriptor):
+            self.chapter_of[code_key(start):code_key(end) + 1] = i
+
+        for i, (start, end) in enumerate(zip(self.blocks['start'],
+                                             self.blocks['end'])):
+            self.block_of[code_key(start):code_key(end) + 1] = i
+
+        self.block_tree = block_tree(self.blocks)
+
+    def _slots(self, codes):
+        prefix = (codes.where(codes.map(lambda x: isinstance(x, str)), '')
+            .str.strip().str.upper().str[:3])
+        valid = prefix.str.fullmatch(r'[A-Z][0-9]{2}').to_numpy(dtype = bool)
+
+        chars = (prefix[valid].to_numpy(dtype = 'U3').view(np.uint32)
+            .reshape(-1, 3).astype(np.int64) - [ord('A'), ord('0'), ord('0')])
+        slots = np.full(len(codes), -1, dtype = np.int16)
+        slots[valid] = chars[:, 0] * 100 + chars[:, 1] * 10 + chars[:, 2]
+
+        return slots
+
+    def _levels(self, slots):
+        known = slots >= 0
+
+        return (np.where(known, self.chapter_of[slots], -1).astype(np.int16),
+                np.where(known, self.block_of[slots], -1).astype(np.int16),
+                slots)
+
+    def rollup(self, data, code_col = 'ICD10'):
+        idx, uniques = pd.factorize(data[code_col])
+        uniques = pd.Series(uniques, dtype = object)
+
+        spans = {i: parse_range(code) for i, code in enumerate(uniques)}
+        spans = {i: span for i, span in spans.items()
+                 if span is not None and span[0] != span[1]}
+
+        chapter, block, category = self._levels(np.append(
+            self._slots(uniques), -1))
+        rows = pd.DataFrame({'chapter': chapter[idx], 'block': block[idx],
+            'category': category[idx]}, index = data.index)
+
+        plain = ~np.isin(idx, list(spans))
+        frames = [data[plain].join(rows[plain])]
+
+        for i, (lo, hi) in spans.items():
+            b_ids = sorted(self.block_tree.overlap(lo, hi))
+            b_slots = np.array([code_key(self.blocks['start'][b])
+                                for b in b_ids], dtype = np.int16)
+
+            if not len(b_ids):
+                b_ids, b_slots = [-1], np.array([lo], dtype = np.int16)
+
+            levels = pd.DataFrame({'chapter': self._levels(b_slots)[0],
+                'block': np.asarray(b_ids, dtype = np.int16),
+                'category': np.int16(-1)})
+            frames.append(data[idx == i].merge(levels, how = 'cross'))
+
+        return pd.concat(frames, ignore_index = True).astype(
+            {'chapter': np.int16, 'block': np.int16, 'category': np.int16})
+
+    def levels(self):
+        return pd.concat([
+            pd.DataFrame({'level': 'chapter', 'id': range(len(self.chapters)),
+                          'label': self.chapters}),
+            pd.DataFrame({'level': 'block', 'id': self.blocks.index,
+                          'label': self.blocks['start'] + '-' +
+                          self.blocks['end'] + ' ' + self.blocks['label']}),
+            pd.DataFrame({'level': 'category', 'id': range(n_slots),
+                          'label': [key_code(key) for key in range(n_slots)]})
+            ], ignore_index = True)
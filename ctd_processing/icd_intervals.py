@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+ICD-10 code ranges as intervals
+
+Range codes such as 'M45-M49.9' are parsed into closed intervals over the
+three-character category space (letter * 100 + number) and matched
+against a static interval tree over the chapter (descriptor) or block
+(Data/icd10_blocks.csv) ranges, so a range maps to every chapter or block
+it spans. Overlap and point queries are O(log n + k).
+"""
+
+import re
+import logging
+from functools import lru_cache
+import pandas as pd
+
+
+range_pattern = re.compile(r'^\s*([A-Z])(\d{2})(?:\.\w*)?\s*-\s*([A-Z])?(\d{2})'
+                           r'(?:\.\w*)?\s*$', re.IGNORECASE)
+
+
+def code_key(code):
+    code = code.strip().upper()
+
+    return (ord(code[0]) - ord('A')) * 100 + int(code[1:3])
+
+
+def key_code(key):
+    return f"{chr(ord('A') + key // 100)}{key % 100:02d}"
+
+
+def parse_range(code):
+    if not isinstance(code, str):
+        return None
+
+    match = range_pattern.match(code)
+
+    if match is None:
+        return None
+
+    letter, start, end_letter, end = match.groups()
+    lo = code_key(f"{letter}{start}")
+    hi = code_key(f"{end_letter or letter}{end}")
+
+    return (lo, hi) if lo <= hi else (hi, lo)
+
+
+class IntervalTree:
+    def __init__(self, intervals):
+        items = sorted(intervals, key = lambda item: (item[0], item[1]))
+
+        self.lo = [item[0] for item in items]
+        self.hi = [item[1] for item in items]
+        self.values = [item[2] for item in items]
+        self.max_hi = [None] * len(items)
+
+        self._build(0, len(items))
+
+    def __len__(self):
+        return len(self.values)
+
+    def _build(self, a, b):
+        if a >= b:
+            return float('-inf')
+
+        m = (a + b) // 2
+        self.max_hi[m] = max(self.hi[m], self._build(a, m),
+                             self._build(m + 1, b))
+
+        return self.max_hi[m]
+
+    def overlap(self, lo, hi):
+        found = []
+        self._query(0, len(self.values), lo, hi, found)
+
+        return found
+
+    def stab(self, point):
+        return self.overlap(point, point)
+
+    def _query(self, a, b, lo, hi, found):
+        if a >= b:
+            return
+
+        m = (a + b) // 2
+
+        if self.max_hi[m] < lo:
+            return
+
+        self._query(a, m, lo, hi, found)
+
+        if self.lo[m] <= hi:
+            if self.hi[m] >= lo:
+                found.append(self.values[m])
+
+            self._query(m + 1, b, lo, hi, found)
+
+
+@lru_cache(maxsize = None)
+def range_tree(ranges):
+    return IntervalTree((code_key(start), code_key(end), label)
+                        for start, end, label in ranges)
+
+
+def descriptor_tree(descriptor):
+    return range_tree(tuple(map(tuple, descriptor)))
+
+
+def block_tree(blocks):
+    return range_tree(tuple(zip(blocks['start'], blocks['end'],
+                                range(len(blocks)))))
+
+
+def range_labels(tree, codes, level):
+    spans = {}
+
+    for code in pd.unique(codes):
+        interval = parse_range(code)
+
+        if interval is not None:
+            spans[code] = tree.overlap(*interval)
+
+    if spans:
+        multi = sum(len(labels) > 1 for labels in spans.values())
+
+        logging.info(f"{len(spans)} ICD-10 range codes found "
+                     f"({int(codes.isin(list(spans)).sum())} rows), "
+                     f"{multi} spanning more than one {level}.")
+
+    return codes.map(spans)
+
+
+def range_chapters(descriptor, codes):
+    spans = range_labels(descriptor_tree(descriptor), codes, 'chapter')
+
+    return spans.map(lambda labels: labels or ['Other'], na_action = 'ignore')
+
+
+def range_blocks(blocks, codes):
+    return range_labels(block_tree(blocks), codes, 'block')
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse trial x keyword incidence of DHT flag matches
+
+One CSR matrix per searched text column keeps the provenance of every
+match; the trial-level matrix is their boolean union.
+"""
+
+from functools import cached_property
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class KeywordIncidence:
+    def __init__(self, trials, keywords, matrices):
+        self.trials = np.asarray(trials, dtype = str)
+        self.keywords = np.asarray(keywords, dtype = str)
+        self.matrices = matrices
+
+    @classmethod
+    def from_frame(cls, frame, columns, keywords = (), id_col = 'NCT_id',
+                   prefix = '_'):
+        found = set()
+
+        for col in columns:
+            for item in frame[f"{prefix}{col}"]:
+                if isinstance(item, list):
+                    found.update(item)
+
+        keywords = sorted(set(kw.lower().strip() for kw in keywords) | found)
+        kw_index = {kw: j for j, kw in enumerate(keywords)}
+        matrices = {}
+
+        for col in columns:
+            rows, cols = [], []
+
+            for i, item in enumerate(frame[f"{prefix}{col}"]):
+                if isinstance(item, list):
+                    rows.extend([i] * len(item))
+                    cols.extend(kw_index[kw] for kw in item)
+
+            matrices[col] = sparse.csr_matrix(
+                (np.ones(len(rows), dtype = np.uint8), (rows, cols)),
+                shape = (len(frame), len(keywords)))
+            matrices[col].sum_duplicates()
+            matrices[col].data[:] = 1
+
+        return cls(frame[id_col].astype(str).to_numpy(), keywords, matrices)
+
+    @cached_property
+    def trial_matrix(self):
+        matrix = sparse.csr_matrix((len(self.trials), len(self.keywords)),
+            dtype = np.uint8)
+
+        for col_matrix in self.matrices.values():
+            matrix = matrix.maximum(col_matrix)
+
+        return matrix
+
+    def frequency(self, level = 'column'):
+        if level == 'trial':
+            counts = np.asarray(self.trial_matrix.sum(axis = 0)).ravel()
+
+        else:
+            counts = sum(np.asarray(m.sum(axis = 0, dtype = np.int64)).ravel()
+                         for m in self.matrices.values())
+
+        counts = pd.Series(counts, index = self.keywords, dtype = np.int64)
+
+        return counts[counts > 0]
+
+    def by_column(self):
+        return pd.DataFrame({col: np.asarray(m.sum(axis = 0)).ravel()
+            for col, m in self.matrices.items()}, index = self.keywords)
+
+    def cooccurrence(self, keywords = None):
+        matrix = self.trial_matrix.astype(np.int32)
+
+        if keywords is not None:
+            idx = np.flatnonzero(np.isin(self.keywords, list(keywords)))
+            matrix = matrix[:, idx]
+
+        return (matrix.T @ matrix).tocsr()
+
+    def trials_with(self, keyword):
+        j = np.flatnonzero(self.keywords == keyword)
+
+        if not len(j):
+            return self.trials[:0]
+
+        return self.trials[self.trial_matrix[:, j[0]].nonzero()[0]]
+
+    def save(self, file_name):
+        arrays = {'trials': self.trials, 'keywords': self.keywords,
+                  'columns': np.asarray(list(self.matrices), dtype = str)}
+
+        for i, matrix in enumerate(self.matrices.values()):
+            arrays[f"indptr_{i}"] = matrix.indptr
+            arrays[f"indices_{i}"] = matrix.indices
+
+        np.savez_compressed(file_name, **arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as arrays:
+            shape = (len(arrays['trials']), len(arrays['keywords']))
+            matrices = {}
+
+            for i, col in enumerate(arrays['columns']):
+                indices = arrays[f"indices_{i}"]
+                matrices[str(col)] = sparse.csr_matrix(
+                    (np.ones(len(indices), dtype = np.uint8), indices,
+                     arrays[f"indptr_{i}"]), shape = shape)
+
+            return cls(arrays['trials'], arrays['keywords'], matrices)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite cache of batch labels per category, expression, model and prompt
+"""
+
+import json
+import hashlib
+import logging
+import sqlite3
+import pandas as pd
+
+
+class LabelCache:
+    def __init__(self, file_name, openAI_model, prompt_template):
+        logging.basicConfig(level = logging.INFO,
+            format = "%(asctime)s - %(levelname)s - %(message)s")
+
+        self.model = openAI_model
+        self.prompt_template = prompt_template
+        self.conn = sqlite3.connect(file_name)
+
+        with self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS labels (
+                       cat_title TEXT NOT NULL,
+                       norm_exp TEXT NOT NULL,
+                       model TEXT NOT NULL,
+                       prompt_hash TEXT NOT NULL,
+                       piv_cat TEXT NOT NULL,
+                       PRIMARY KEY (cat_title, norm_exp, model, prompt_hash)
+                   )""")
+
+    @staticmethod
+    def normalize(exp):
+        return ' '.join(str(exp).lower().split())
+
+    def prompt_hash(self, scat):
+        key = self.prompt_template + json.dumps(list(scat))
+
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+    def lookup(self, cat, exp, scat):
+        p_hash = self.prompt_hash(scat)
+
+        labels = dict(self.conn.execute(
+            """SELECT norm_exp, piv_cat FROM labels
+               WHERE cat_title = ? AND model = ? AND prompt_hash = ?""",
+            (cat, self.model, p_hash)).fetchall())
+
+        hits = [(cat, i, labels[self.normalize(i)]) for i in exp
+                if self.normalize(i) in labels]
+        misses = [i for i in exp if self.normalize(i) not in labels]
+
+        logging.info(f"Label cache: {len(hits)} of {len(exp)} '{cat}' "
+                     "expressions answered locally.")
+
+        return (pd.DataFrame(hits, columns = ['cat_title', 'cat_exp',
+                'piv_cat']), misses)
+
+    def store(self, cat, scat, result):
+        p_hash = self.prompt_hash(scat)
+
+        result = result[(result['cat_title'] == cat) &
+                        (result['piv_cat'].isin(scat))]
+
+        with self.conn:
+            self.conn.executemany(
+                """INSERT OR REPLACE INTO labels
+                   (cat_title, norm_exp, model, prompt_hash, piv_cat)
+                   VALUES (?, ?, ?, ?, ?)""",
+                [(cat, self.normalize(i), self.model, p_hash, j)
+                 for i, j in zip(result['cat_exp'], result['piv_cat'])])
+
+        return len(result)
+
+    def close(self):
+        self.conn.close()
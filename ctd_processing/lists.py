@@ -5,21 +5,16 @@ Created on Mon Oct  7 23:37:33 2024
 @author: AnatolFiete.Naeher
 """
 
-from ctd_processing.data_prep import data_prep1
-from ctd_processing.ctd_load import d_CTD
-   
-
-d_CTD['CTD_2'] = data_prep1(d_CTD)
-
 key = ["race", "ethnicity", "gender", "sex", "male", "female", "age", 
        "enrollment"]
 
-m = {}
 
-m = [
-    item for item in d_CTD['CTD_2']['title']
-    if any(key.lower() in item.lower().split() for key in key)
-]
+def c_candidates(titles, key = key):
+    return [
+        item for item in titles
+        if any(key.lower() in item.lower().split() for key in key)
+    ]
+
 
 vis = ['Age',
  'Age (<60 or ≥60 years)',
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Local content-addressed cache of the MeSH <-> ICD-10 mapping TSVs
+
+Each downloaded TSV is stored under its sha256 digest and verified against
+the digest recorded in the manifest (and against map_checksums, if pinned)
+whenever it is read. The cleaned Map_3 table is cached under the combined
+digest of both inputs, so _proc_maps only reruns when a mapping changes.
+
+Normal runs never touch the network once the TSVs are cached; refresh with
+    python -m ctd_processing.map_cache --refresh
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import urllib.request
+from datetime import datetime, timezone
+import pandas as pd
+from config.settings import path, urls, cache_dir, map_checksums
+from ctd_processing import store
+
+
+def _map_dir(path):
+    return os.path.join(path, cache_dir, 'maps')
+
+
+def _manifest_path(path):
+    return os.path.join(_map_dir(path), 'maps.json')
+
+
+def _load_manifest(path):
+    m_path = _manifest_path(path)
+
+    if not os.path.isfile(m_path):
+        return {}
+
+    with open(m_path, 'r') as file:
+        return json.load(file)
+
+
+def _save_manifest(path, manifest):
+    m_path = _manifest_path(path)
+
+    with open(f"{m_path}.tmp", 'w') as file:
+        json.dump(manifest, file, indent = 2)
+
+    os.replace(f"{m_path}.tmp", m_path)
+
+
+def _digest(f_path):
+    sha = hashlib.sha256()
+
+    with open(f_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def _verify(key, digest):
+    pinned = map_checksums.get(key)
+
+    if pinned and pinned != digest:
+        raise ValueError(f"{key}: checksum {digest} does not match pinned "
+                         f"checksum {pinned}")
+
+
+def fetch_map(key, url, path = path):
+    logging.info(f"Fetching {key} from {url}...")
+
+    os.makedirs(_map_dir(path), exist_ok = True)
+
+    with urllib.request.urlopen(url) as response:
+        content = response.read()
+
+    digest = hashlib.sha256(content).hexdigest()
+    _verify(key, digest)
+
+    b_path = os.path.join(_map_dir(path), f"{digest}.tsv")
+
+    if not os.path.isfile(b_path):
+        with open(f"{b_path}.tmp", 'wb') as file:
+            file.write(content)
+
+        os.replace(f"{b_path}.tmp", b_path)
+
+    manifest = _load_manifest(path)
+    manifest[key] = {'url': url, 'sha256': digest,
+                     'fetched': datetime.now(timezone.utc).isoformat()}
+    _save_manifest(path, manifest)
+
+    return digest
+
+
+def map_digest(key, path = path, urls = urls):
+    entry = _load_manifest(path).get(key)
+
+    if entry is None or entry['url'] != urls[key] or not os.path.isfile(
+            os.path.join(_map_dir(path), f"{entry['sha256']}.tsv")):
+        return fetch_map(key, urls[key], path)
+
+    return entry['sha256']
+
+
+def load_map(key, path = path, urls = urls):
+    digest = map_digest(key, path, urls)
+    b_path = os.path.join(_map_dir(path), f"{digest}.tsv")
+
+    if _digest(b_path) != digest:
+        raise ValueError(f"{key}: cached copy {b_path} is corrupt - run "
+                         "python -m ctd_processing.map_cache --refresh")
+
+    _verify(key, digest)
+
+    logging.info(f"Loading {key} from local cache ({digest[:12]})...")
+
+    return pd.read_csv(b_path, sep = '\t')
+
+
+def load_map3(path = path, urls = urls):
+    from ctd_processing.ICD_mappings import _proc_maps
+
+    keys = ['Map_1', 'Map_2']
+    digest = hashlib.sha256(''.join(map_digest(key, path, urls)
+        for key in keys).encode('utf-8')).hexdigest()[:16]
+    c_path = os.path.join(_map_dir(path), f"Map_3_{digest}.parquet")
+
+    if os.path.isfile(c_path) or os.path.isfile(
+            c_path.replace('.parquet', '.csv')):
+        logging.info(f"Loading cleaned Map_3 from local cache ({digest})...")
+
+        return store.read_table(c_path, name = 'Map_3')
+
+    Map_3 = _proc_maps({key: load_map(key, path, urls) for key in keys}) \
+        ['Map_3']
+    store.write_table(Map_3, c_path, 'Map_3')
+
+    return Map_3
+
+
+def refresh_maps(path = path, urls = urls):
+    for key, url in urls.items():
+        old = _load_manifest(path).get(key, {}).get('sha256')
+        new = fetch_map(key, url, path)
+
+        print(f"{key}: {'unchanged' if old == new else 'updated'} "
+              f"({new[:12]})")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO,
+        format = "%(asctime)s - %(levelname)s - %(message)s")
+
+    if '--refresh' in sys.argv:
+        refresh_maps(path, urls)
+
+    else:
+        for key in urls:
+            print(f"{key}: {map_digest(key, path, urls)[:12]}")
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-pattern keyword matching (Aho-Corasick)
+
+Matches follow the semantics of the alternation regex r'\b(kw1|kw2|...)\b'
+with re.IGNORECASE and the keywords ordered longest first: matches are
+leftmost-longest, non-overlapping and must sit on word boundaries. Uses the
+pyahocorasick automaton when installed and a pure Python automaton
+otherwise.
+"""
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+def _is_word(c):
+    return c.isalnum() or c == '_'
+
+
+def _boundary(text, i):
+    return ((i > 0 and _is_word(text[i - 1])) != 
+            (i < len(text) and _is_word(text[i])))
+
+
+class KeywordMatcher:
+    def __init__(self, keywords):
+        self.keywords = sorted(set(kw.lower() for kw in keywords if kw))
+
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+
+            for kw in self.keywords:
+                self.automaton.add_word(kw, len(kw))
+
+            self.automaton.make_automaton()
+
+        else:
+            self.automaton = None
+            self._build()
+
+    def _build(self):
+        self.goto = [{}]
+        self.out = [0]
+
+        for kw in self.keywords:
+            node = 0
+
+            for c in kw:
+                if c not in self.goto[node]:
+                    self.goto.append({})
+                    self.out.append(0)
+                    self.goto[node][c] = len(self.goto) - 1
+
+                node = self.goto[node][c]
+
+            self.out[node] = len(kw)
+
+        self.fail = [0] * len(self.goto)
+        self.link = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+
+        for node in queue:
+            for c, child in self.goto[node].items():
+                f = self.fail[node]
+
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+
+                f = self.goto[f].get(c, 0)
+                self.fail[child] = f if f != child else 0
+                self.link[child] = (self.fail[child] if
+                    self.out[self.fail[child]] else self.link[self.fail[child]])
+
+                queue.append(child)
+
+    def _scan(self, text):
+        if not self.keywords:
+            return
+
+        if self.automaton is not None:
+            for end, n in self.automaton.iter(text):
+                yield end - n + 1, end + 1
+
+            return
+
+        goto, fail, out, link = self.goto, self.fail, self.out, self.link
+        node = 0
+
+        for i, c in enumerate(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+
+            node = goto[node].get(c, 0)
+            hit = node if out[node] else link[node]
+
+            while hit:
+                yield i - out[hit] + 1, i + 1
+                hit = link[hit]
+
+    def finditer(self, text):
+        lc_text = text.lower()
+
+        if len(lc_text) != len(text):
+            lc_text = ''.join(c if len(c.lower()) != 1 else c.lower()
+                              for c in text)
+
+        spans = [
+            (start, end) for start, end in self._scan(lc_text)
+            if _boundary(lc_text, start) and _boundary(lc_text, end)
+        ]
+        spans.sort(key = lambda span: (span[0], -span[1]))
+
+        last = -1
+
+        for start, end in spans:
+            if start >= last:
+                last = end
+
+                yield lc_text[start:end]
+
+    def findall(self, text):
+        return list(self.finditer(text))
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Sparse MeSH term -> ICD-10 incidence
+
+The term x ICD-10 matrix is A @ B + C, where
+- A: term x MeSH id for MICD rows whose MeSH id appears in Map_3
+- B: MeSH id x ICD-10 from Map_3
+- C: term x ICD-10 for MICD rows whose MeSH id is not in Map_3
+matching the fallback of _merge_maps to the MICD code. Trial x ICD-10 is
+then a single product with the trial x term incidence of CTD_5.
+
+The index is persisted as plain .npy arrays (sorted terms, codes and the
+CSR structure) under cache/mesh_index/<key>, where the key combines
+index_version with the checksums of MICD.csv, Map_1 and Map_2. Later runs
+memory-map the arrays instead of rebuilding. Build ahead of a run with
+    python -m ctd_processing.mesh_index
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from config.settings import path, cache_dir
+
+
+index_version = 1
+
+
+def _incidence(rows, cols, shape):
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype = np.int32),
+        (rows, cols)), shape = shape)
+    matrix.sum_duplicates()
+
+    return matrix
+
+
+class MeshICDIndex:
+    def __init__(self, terms, codes, matrix):
+        self.terms = np.asarray(terms, dtype = str)
+        self.codes = np.asarray(codes, dtype = str)
+        self.matrix = matrix
+
+    @classmethod
+    def build(cls, MICD, Map_3):
+        Map_3 = Map_3[Map_3['MESH_id'].notna() & Map_3['ICD10CM_id'].notna()]
+
+        t_idx, terms = pd.factorize(MICD['MESH_term'].str.lower(),
+            sort = True)
+        m_idx, meshes = pd.factorize(Map_3['MESH_id'])
+        codes = pd.Index(np.sort(pd.unique(pd.concat([Map_3['ICD10CM_id'],
+            MICD['ICD10CM_id']]).astype(str))))
+
+        B = _incidence(m_idx, codes.get_indexer(Map_3['ICD10CM_id']
+            .astype(str)), (len(meshes), len(codes)))
+
+        r_mesh = pd.Index(meshes).get_indexer(MICD['MESH_id'])
+        mapped = (r_mesh >= 0) & (t_idx >= 0)
+        own = (r_mesh < 0) & (t_idx >= 0)
+
+        A = _incidence(t_idx[mapped], r_mesh[mapped],
+            (len(terms), len(meshes)))
+        C = _incidence(t_idx[own], codes.get_indexer(MICD['ICD10CM_id']
+            [own].astype(str)), (len(terms), len(codes)))
+
+        matrix = (A @ B + C).tocsr()
+        matrix.data[:] = 1
+
+        return cls(terms, codes, matrix.astype(np.uint8))
+
+    def lookup(self, terms):
+        terms = pd.Series(terms, dtype = object)
+        valid = terms.notna().to_numpy()
+        query = terms[valid].str.lower().to_numpy(dtype = str)
+
+        pos = np.minimum(np.searchsorted(self.terms, query),
+            max(len(self.terms) - 1, 0))
+        term_idx = np.full(len(terms), -1, dtype = np.int64)
+
+        if len(self.terms):
+            term_idx[np.flatnonzero(valid)] = np.where(
+                self.terms[pos] == query, pos, -1)
+
+        return term_idx
+
+    def apply(self, CTD_5, id_col = 'NCT_id'):
+        term_idx = self.lookup(CTD_5.iloc[:, 1])
+        found = (term_idx >= 0) & CTD_5.iloc[:, 0].notna().to_numpy()
+        trial_idx, trials = pd.factorize(CTD_5.iloc[:, 0][found])
+
+        T = _incidence(trial_idx, term_idx[found],
+            (len(trials), len(self.terms)))
+
+        product = (T @ self.matrix).tocoo()
+        order = np.lexsort((product.col, product.row))
+
+        return pd.DataFrame({
+            id_col: np.asarray(trials, dtype = object)[product.row[order]],
+            'ICD10': self.codes[product.col[order]].astype(object)})
+
+    def save(self, i_dir):
+        tmp_dir = f"{i_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+        os.makedirs(tmp_dir)
+
+        arrays = {'terms': self.terms, 'codes': self.codes,
+                  'indptr': self.matrix.indptr,
+                  'indices': self.matrix.indices}
+
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as file:
+            json.dump({'version': index_version,
+                       'shape': list(self.matrix.shape)}, file)
+
+        shutil.rmtree(i_dir, ignore_errors = True)
+        os.replace(tmp_dir, i_dir)
+
+    @classmethod
+    def load(cls, i_dir):
+        with open(os.path.join(i_dir, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+
+        arrays = {name: np.load(os.path.join(i_dir, f"{name}.npy"),
+            mmap_mode = 'r') for name in ['terms', 'codes', 'indptr',
+            'indices']}
+
+        matrix = sparse.csr_matrix((np.ones(len(arrays['indices']),
+            dtype = np.uint8), arrays['indices'], arrays['indptr']),
+            shape = tuple(meta['shape']), copy = False)
+
+        return cls(arrays['terms'], arrays['codes'], matrix)
+
+
+def _file_digest(f_path):
+    sha = hashlib.sha256()
+
+    with open(f_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def index_key(path = path):
+    from ctd_processing.map_cache import map_digest
+
+    digests = [_file_digest(os.path.join(path, 'MICD.csv'))]
+    digests += [map_digest(key, path) for key in ['Map_1', 'Map_2']]
+
+    return hashlib.sha256(f"{index_version}:{':'.join(digests)}"
+        .encode('utf-8')).hexdigest()[:16]
+
+
+def cached_index(path, build):
+    if not os.path.isfile(os.path.join(path, 'MICD.csv')):
+        return build()
+
+    key = index_key(path)
+    i_dir = os.path.join(path, cache_dir, 'mesh_index', key)
+
+    if os.path.isfile(os.path.join(i_dir, 'meta.json')):
+        logging.info(f"Loading MeSH -> ICD-10 index {key}...")
+
+        return MeshICDIndex.load(i_dir)
+
+    logging.info(f"Building MeSH -> ICD-10 index {key}...")
+
+    index = build()
+    index.save(i_dir)
+
+    return index
+
+
+def build_index(path = path):
+    from ctd_processing.ctd_load import CTDLoader
+    from ctd_processing.ICD_mappings import _proc_micd
+
+    d_CTD = CTDLoader(path = path)
+    data = _proc_micd({'MICD': d_CTD['MICD'].copy()})
+
+    return cached_index(path, lambda: MeshICDIndex.build(data['MICD'],
+        d_CTD['Map_3']))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO,
+        format = "%(asctime)s - %(levelname)s - %(message)s")
+
+    index = build_index(path)
+
+    print(f"MeSH -> ICD-10 index: {len(index.terms)} terms, "
+          f"{len(index.codes)} codes, {index.matrix.nnz} links")
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Local labelling of trivially classifiable category expressions
+"""
+
+import re
+import logging
+import pandas as pd
+from config.settings import cat_synonyms, age_bins
+
+
+class PreClassifier:
+    units = {'month': 12, 'week': 52, 'day': 365}
+    max_age = 120
+
+    def __init__(self, cat_dict, synonyms = cat_synonyms, bins = age_bins):
+        logging.basicConfig(level = logging.INFO,
+            format = "%(asctime)s - %(levelname)s - %(message)s")
+
+        self.bins = {label: span for label, span in bins.items()
+                     if label in cat_dict.get('age', [])}
+        self.lookup = {}
+        self.stats = {}
+
+        for cat, scat in cat_dict.items():
+            self.lookup[cat] = {self.normalize(label): label for label in scat}
+
+            for label, syns in synonyms.get(cat, {}).items():
+                if label in scat:
+                    self.lookup[cat].update(
+                        {self.normalize(syn): label for syn in syns})
+
+    @staticmethod
+    def normalize(exp):
+        exp = ' '.join(str(exp).lower().split())
+
+        return exp.strip(' .:;,')
+
+    def classify(self, cat, exp):
+        hits = []
+        misses = []
+
+        for i in exp:
+            label = self.lookup.get(cat, {}).get(self.normalize(i))
+
+            if label is None and cat == 'age':
+                label = self.age_label(i)
+
+            if label is None:
+                misses.append(i)
+
+            else:
+                hits.append((cat, i, label))
+
+        self.stats[cat] = (len(hits), len(exp))
+
+        return (pd.DataFrame(hits, columns = ['cat_title', 'cat_exp',
+                'piv_cat']), misses)
+
+    def age_label(self, exp):
+        span = self.age_span(exp)
+
+        if span is None:
+            return None
+
+        lo, hi = span
+        labels = [label for label, (b_lo, b_hi) in self.bins.items()
+                  if lo >= b_lo and hi <= b_hi]
+
+        return labels[0] if len(labels) == 1 else None
+
+    def years(self, x, unit):
+        for name, n in self.units.items():
+            if unit and unit.startswith(name):
+                return float(x) / n
+
+        return float(x)
+
+    def age_span(self, exp):
+        t = (self.normalize(exp).replace('≥', '>=').replace('≤', '<=')
+             .replace('–', '-').replace('—', '-').replace(' to ', '-'))
+        t = re.sub(r"\b(old|of age|aged?)\b", ' ', t)
+        t = ' '.join(t.split())
+
+        num = r"(\d+(?:\.\d+)?)(?: ?(years?|yrs?|y|months?|weeks?|days?)\b)?"
+
+        # each number carries its own unit; a bare range bound takes the
+        # unit of the other bound
+        m = (re.fullmatch(rf"{num} ?- ?{num}", t) or
+             re.fullmatch(rf"between {num} and {num}", t))
+
+        if m:
+            x, u, y, v = m.groups()
+            lo, hi = self.years(x, u or v), self.years(float(y) + 1, v or u)
+
+        elif m := re.fullmatch(rf"(<=|>=|<|>|=) ?{num}", t):
+            x, u = float(m.group(2)), m.group(3)
+            lo, hi = {'<': (0, x), '<=': (0, x + 1), '>': (x + 1,
+                float('inf')), '>=': (x, float('inf')), '=': (x, x + 1)
+                }[m.group(1)]
+            lo, hi = self.years(lo, u), self.years(hi, u)
+
+        elif m := re.fullmatch(rf"{num} ?(\+|or older|and older|or over|"
+                               r"and over|or above|and above|or more|"
+                               r"and up)", t):
+            lo, hi = self.years(m.group(1), m.group(2)), float('inf')
+
+        elif m := re.fullmatch(rf"(under|younger than|less than|below) {num}",
+                               t):
+            lo, hi = 0, self.years(m.group(2), m.group(3))
+
+        elif m := re.fullmatch(rf"(over|older than|greater than|above|"
+                               rf"more than) {num}", t):
+            lo, hi = self.years(float(m.group(2)) + 1, m.group(3)), \
+                float('inf')
+
+        elif m := re.fullmatch(num, t):
+            lo, hi = (self.years(m.group(1), m.group(2)),
+                      self.years(float(m.group(1)) + 1, m.group(2)))
+
+        else:
+            return None
+
+        if lo >= hi or lo > self.max_age:
+            return None
+
+        return lo, hi
+
+    def report(self):
+        hits = sum(i for i, _ in self.stats.values())
+        total = sum(j for _, j in self.stats.values())
+
+        for cat, (i, j) in self.stats.items():
+            logging.info(f"Pre-classifier: {i} of {j} '{cat}' expressions "
+                         f"labelled locally ({i / j:.1%})." if j else
+                         f"Pre-classifier: no '{cat}' expressions.")
+
+        logging.info(f"Pre-classifier hit rate: {hits} of {total} "
+                     f"({hits / total if total else 0:.1%}).")
+
+        return hits / total if total else 0
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Compact dtypes for the d_CTD tables
+
+NCTInterner maps NCT ids to int32 codes through one shared vocabulary, so
+every table joins on integer keys; fit() assigns codes in sorted id order,
+so groupby results keep the order of the string ids. compact() stores
+low-cardinality enum columns as categoricals.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class NCTInterner:
+    def __init__(self):
+        self.vocab = pd.Index([], dtype = object)
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def fit(self, *columns):
+        values = pd.concat([pd.Series(col, dtype = object) for col in columns])
+        self.encode(np.sort(values.dropna().unique()))
+
+        return self
+
+    def encode(self, values):
+        values = pd.Series(values).astype(object)
+        codes = self.vocab.get_indexer(values)
+        new = values[(codes == -1) & values.notna().to_numpy()].unique()
+
+        if len(new):
+            self.vocab = self.vocab.append(pd.Index(new, dtype = object))
+            codes = self.vocab.get_indexer(values)
+
+        return codes.astype(np.int32)
+
+    def decode(self, codes):
+        codes = np.asarray(codes)
+        valid = codes >= 0
+        values = np.full(len(codes), None, dtype = object)
+        values[valid] = self.vocab.to_numpy()[codes[valid].astype(np.int64)]
+
+        return values
+
+    def encode_frame(self, df, id_col = 'NCT_id'):
+        return df.assign(**{id_col: self.encode(df[id_col])})
+
+    def decode_frame(self, df, id_col = 'NCT_id'):
+        return df.assign(**{id_col: self.decode(df[id_col])})
+
+
+def compact(df, columns):
+    columns = [col for col in columns if col in df.columns]
+
+    return df.astype({col: 'category' for col in columns})
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar, typed cache for intermediate tables
+
+Tables are stored as zstd-compressed Parquet files with an explicit schema
+per table (table_schemas), native list columns and column projection on
+read. Columns without a schema entry are inferred. Falls back to CSV when
+pyarrow is not installed. Both paths pass through conform(), so a table
+reads back the same from CSV and from Parquet: missing values are NaN,
+dates are datetime64 and integer columns are int64 unless they hold NaN.
+
+AACT delta refreshes are kept as numbered segments under aact_delta/: the
+rows of the updated trials per table plus a tombstone list of every
+updated or withdrawn nct_id. apply_deltas() drops tombstoned trials from
+a base table and appends the segment rows in order, so a refresh never
+rewrites the base CSVs. A full extraction clears the segments.
+
+Schema types:
+- 'string', 'int', 'int16', 'float', 'bool', 'date'
+- 'list': list of strings
+- 'matches': list of strings, where the DHT_search marker 'no matches' is
+  stored as an empty list
+"""
+
+import os
+import ast
+import shutil
+import numpy as np
+import pandas as pd
+from config.settings import cache_dir, dflg_columns, dflg_colname, \
+    dflg_filename, icd10_rollup_filename, aact_delta_dir
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+_string = lambda *cols: {col: 'string' for col in cols}
+
+table_schemas = {
+    'CTD_1': {**_string('nct_id', 'study_type', 'overall_status', 'phase',
+                        'sampling_method', 'gender', 'minimum_age',
+                        'maximum_age', 'name'),
+              'is_fda_regulated_drug': 'bool',
+              'is_fda_regulated_device': 'bool',
+              'is_unapproved_device': 'bool', 'enrollment': 'int',
+              'start_date': 'date', 'completion_date': 'date',
+              'number_of_arms': 'int', 'were_results_reported': 'bool'},
+    'CTD_2': {**_string('nct_id', 'ctgov_group_code', 'classification',
+                        'category', 'title', 'units', 'param_type'),
+              'count': 'int', 'param_value_num': 'float'},
+    'CTD_3': _string('nct_id', 'intervention_type', 'name', 'description'),
+    'CTD_4': _string('nct_id', 'agency_class', 'lead_or_collaborator'),
+    'CTD_5': _string('nct_id', 'mesh_term'),
+    'CTD_6': _string('nct_id', 'official_title', 'intervention_type', 'name',
+                     'q_3_desc', 'q_7_desc', 'title', 'q_8_desc', 'measure',
+                     'q_9_desc', 'q_10_desc'),
+    'b_output': _string('cat_title', 'cat_exp', 'piv_cat'),
+    'MICD': _string('id', 'label', 'icd_code', 'mesh_code'),
+    'dht_icd10': _string('study_id', 'icd10_code'),
+    'Map_3': _string('ICD10CM_id', 'MESH_id'),
+    'icd10_blocks': _string('start', 'end', 'label'),
+    icd10_rollup_filename: {**_string('NCT_id', 'ICD10'),
+                            'chapter': 'int16', 'block': 'int16',
+                            'category': 'int16'},
+    dflg_filename: {**_string('NCT_id', 'DHT_searched_text'),
+                    **{f"_{col}": 'matches' for col in dflg_columns},
+                    dflg_colname: 'int'},
+    'CTD': {**_string('NCT_id'),
+            **{col: 'list' for col in ['study_Country', 'Intervention',
+               'int_Name', 'sp_Class', 'sp_Role', 'ICD10', 'Clinical_Cat',
+               'enroll_Country']}}
+}
+
+_arrow_types = {
+    'string': lambda: pa.string(), 'int': lambda: pa.int64(),
+    'int16': lambda: pa.int16(),
+    'float': lambda: pa.float64(), 'bool': lambda: pa.bool_(),
+    'date': lambda: pa.date32(), 'list': lambda: pa.list_(pa.string()),
+    'matches': lambda: pa.list_(pa.string())
+}
+
+_bools = {True: True, False: False, 'True': True, 'False': False,
+          't': True, 'f': False, 'true': True, 'false': False}
+
+
+def available():
+    return pa is not None
+
+
+def cache_path(path, name):
+    return os.path.join(path, cache_dir, f"{name}.parquet")
+
+
+def _na(value):
+    return not isinstance(value, (list, tuple, np.ndarray)) and pd.isna(value)
+
+
+def _to_pandas_type(col, kind):
+    if kind == 'string':
+        return col.map(lambda v: None if _na(v) else str(v)).astype(object)
+
+    elif kind == 'int':
+        return pd.to_numeric(col, errors = 'coerce').astype('Int64')
+
+    elif kind == 'int16':
+        return pd.to_numeric(col, errors = 'coerce').astype('Int16')
+
+    elif kind == 'float':
+        return pd.to_numeric(col, errors = 'coerce').astype(float)
+
+    elif kind == 'bool':
+        return col.map(_bools).astype('boolean')
+
+    elif kind == 'date':
+        return pd.to_datetime(col, errors = 'coerce').dt.date \
+            .where(col.notna(), None)
+
+    elif kind == 'list':
+        col = col.map(_literal)
+
+        return col.map(lambda v: None if _na(v) else [None if _na(i) else
+                       str(i) for i in v] if isinstance(v, (list, tuple))
+                       else [str(v)])
+
+    elif kind == 'matches':
+        col = col.map(_literal)
+
+        return col.map(lambda v: [str(i) for i in v] if isinstance(v, 
+                       (list, tuple)) else [])
+
+    return col
+
+
+def _literal(value):
+    if isinstance(value, str) and value.startswith('['):
+        return ast.literal_eval(value)
+
+    return value
+
+
+def _from_pandas_type(col, kind):
+    if kind == 'string':
+        return col.map(lambda v: np.nan if _na(v) else str(v)).astype(object)
+
+    elif kind in ('int', 'int16'):
+        col = pd.to_numeric(col, errors = 'coerce')
+
+        return col if col.isna().any() else col.astype(
+            np.int16 if kind == 'int16' else np.int64)
+
+    elif kind == 'float':
+        return pd.to_numeric(col, errors = 'coerce').astype(float)
+
+    elif kind == 'bool':
+        col = col.map(lambda v: np.nan if _na(v) else _bools.get(v, np.nan))
+
+        return col.astype(bool) if col.notna().all() else col.astype(object)
+
+    elif kind == 'date':
+        return pd.to_datetime(col, errors = 'coerce')
+
+    elif kind == 'list':
+        return col.map(lambda v: np.nan if _na(v) else list(_literal(v)))
+
+    elif kind == 'matches':
+        col = col.map(_literal)
+
+        return col.map(lambda v: list(v) if not isinstance(v, str) and
+                       not _na(v) and len(v) else 'no matches')
+
+    return col
+
+
+def conform(df, name = None):
+    schema = table_schemas.get(name, {})
+
+    for col in df.columns:
+        if col in schema:
+            df[col] = _from_pandas_type(df[col], schema[col])
+
+        elif df[col].dtype == object:
+            df[col] = df[col].where(df[col].notna(), np.nan)
+
+    return df
+
+
+def write_table(df, f_path, name = None):
+    os.makedirs(os.path.dirname(f_path), exist_ok = True)
+
+    if pa is None:
+        df.to_csv(f_path.replace('.parquet', '.csv'), index = False)
+
+        return
+
+    schema = table_schemas.get(name, {})
+    df = df.copy()
+    fields = []
+
+    for col in df.columns:
+        kind = schema.get(col)
+
+        if kind is not None:
+            df[col] = _to_pandas_type(df[col], kind)
+            fields.append(pa.field(str(col), _arrow_types[kind]()))
+
+        else:
+            try:
+                fields.append(pa.field(str(col), pa.Table.from_pandas(
+                    df[[col]], preserve_index = False).schema.field(0).type))
+
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[col] = _to_pandas_type(df[col], 'string')
+                fields.append(pa.field(str(col), pa.string()))
+
+    df.columns = [str(col) for col in df.columns]
+
+    table = pa.Table.from_pandas(df, schema = pa.schema(fields),
+        preserve_index = False)
+    pq.write_table(table, f"{f_path}.tmp", compression = 'zstd')
+
+    os.replace(f"{f_path}.tmp", f_path)
+
+
+def read_table(f_path, columns = None, name = None):
+    if pa is None:
+        return conform(pd.read_csv(f_path.replace('.parquet', '.csv'),
+                                   usecols = columns), name)
+
+    return conform(pq.read_table(f_path, columns = columns).to_pandas(
+        ignore_metadata = True), name)
+
+
+def load_table(path, name, f_path, columns = None, reader = pd.read_csv):
+    if pa is None:
+        return conform(reader(f_path, usecols = columns) if columns else
+                       reader(f_path), name)
+
+    c_path = cache_path(path, name)
+
+    if os.path.isfile(c_path) and (not os.path.isfile(f_path) or
+            os.path.getmtime(c_path) >= os.path.getmtime(f_path)):
+        return read_table(c_path, columns, name)
+
+    write_table(reader(f_path), c_path, name)
+
+    return read_table(c_path, columns, name)
+
+
+def _exists(f_path):
+    return os.path.isfile(f_path if pa is not None else
+                          f_path.replace('.parquet', '.csv'))
+
+
+def delta_path(path, segment, name):
+    return os.path.join(path, aact_delta_dir, segment, f"{name}.parquet")
+
+
+def _tombstones(path, segment):
+    return os.path.join(path, aact_delta_dir, segment, 'tombstones.csv')
+
+
+def delta_segments(path):
+    d_dir = os.path.join(path, aact_delta_dir)
+
+    if not os.path.isdir(d_dir):
+        return []
+
+    return sorted(segment for segment in os.listdir(d_dir)
+                  if os.path.isfile(_tombstones(path, segment)))
+
+
+def new_segment(path):
+    d_dir = os.path.join(path, aact_delta_dir)
+    os.makedirs(d_dir, exist_ok = True)
+
+    for segment in set(os.listdir(d_dir)) - set(delta_segments(path)):
+        shutil.rmtree(os.path.join(d_dir, segment), ignore_errors = True)
+
+    segments = delta_segments(path)
+    segment = f"{int(segments[-1]) + 1 if segments else 1:05d}"
+    os.makedirs(os.path.join(d_dir, segment))
+
+    return segment
+
+
+def close_segment(path, segment, ids):
+    f_path = _tombstones(path, segment)
+
+    pd.DataFrame({'nct_id': sorted(ids)}).to_csv(f"{f_path}.tmp",
+                                                index = False)
+    os.replace(f"{f_path}.tmp", f_path)
+
+
+def clear_deltas(path):
+    shutil.rmtree(os.path.join(path, aact_delta_dir), ignore_errors = True)
+
+
+def apply_deltas(path, name, df, columns = None):
+    segments = delta_segments(path)
+
+    if not segments:
+        return df
+
+    for segment in segments:
+        gone = pd.read_csv(_tombstones(path, segment), dtype = str)['nct_id']
+        df = df[~df['nct_id'].isin(gone)]
+
+        if _exists(delta_path(path, segment, name)):
+            df = pd.concat([df, read_table(delta_path(path, segment, name),
+                columns, name)], ignore_index = True)
+
+    return df.reset_index(drop = True)
@@ -8,17 +8,31 @@ Created on Mon Nov 18 09:50:08 2024
 if __name__ == "__main__":
     from openai import OpenAI
     from config.settings import *
-    from ctd_processing.lists import d_CTD, age, gender, race, enrollment
-    from ctd_processing.data_prep import data_prep2    
+    from ctd_processing.ctd_load import CTDLoader
+    from ctd_processing.lists import age, gender, race, enrollment
+    from ctd_processing.data_prep import data_prep1, data_prep2    
     from ctd_processing.batch_jobs import b_jobs
     from ctd_processing.data_prep import merge
+    from ctd_processing.store import write_table, cache_path
     
+    d_CTD = CTDLoader()
+    
+    d_CTD['CTD_2'] = data_prep1(d_CTD)
     d_CTD['CTD_2'] = data_prep2(d_CTD, age, gender, race, enrollment)
     d_CTD['b_output'] = b_jobs(path, batch_filename, prompt_template, cat_dict, 
         d_CTD['CTD_2'], OpenAI())
     CTD = merge(d_CTD)
     
     CTD.to_csv(f"{path}\\{filename}.csv")
+    write_table(CTD, cache_path(path, filename), filename)
+    
+    if 'ICD_rollup' in d_CTD:
+        d_CTD['ICD_rollup'].to_csv(f"{path}\\{icd10_rollup_filename}.csv", 
+            index = False)
+        d_CTD['ICD_levels'].to_csv(
+            f"{path}\\{icd10_rollup_filename}_levels.csv", index = False)
+        write_table(d_CTD['ICD_rollup'], cache_path(path, 
+            icd10_rollup_filename), icd10_rollup_filename)
     
     print(f"Clinical trial data processing completed. {filename}.csv"
           f" saved in {path}")